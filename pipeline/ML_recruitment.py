@@ -25,15 +25,17 @@ from sklearn import tree,metrics,preprocessing
 from sklearn.model_selection import train_test_split
 import collections
 import argparse
-#For kmer matrix reduction
-from scipy import stats
-import math
-from sklearn import decomposition
 #for parallel ML
+import joblib
 from joblib import Parallel, delayed
 import random
 import multiprocessing
 import os
+import pickle
+import shutil
+import tempfile
+from scipy import sparse
+import kmer_functions
 
 parser = argparse.ArgumentParser(description="Recruit unclustered (or non-marker)\
     sequences with Machine Learning classification using clustered sequence\
@@ -53,92 +55,56 @@ parser.add_argument('-u','--unclustered_name', metavar='<unclustered name>', hel
     in cluster column', default="unclustered")
 parser.add_argument('-n','--num_iterations', metavar='<int>', help='Number of iterations for \
     jackknife cross-validation.', type=int, default=10)
-parser.add_argument('-m','--k_mer_matrix', metavar='<k-mer.tab>', help='Path to k-mer_matrix file.', default="k-mer_matrix")
+parser.add_argument('-m','--k_mer_matrix', metavar='<k-mer_matrix>', help='Path to k-mer_matrix file (binary or tab-delimited).', default="k-mer_matrix")
 parser.add_argument('-o','--out_table', metavar='<output.tab>', help='Path to create output table with new column\
     for ML-recruited sequences.',required=True)
 parser.add_argument('-k','--kingdom', metavar='<archaea|bacteria>', help='Kingdom to consider (archaea|bacteria)',\
     choices=['bacteria','archaea'], default = 'bacteria')
+parser.add_argument('--pca_model', metavar='<k-mer_pca.npz>', help='Path to the PCA model written by recursive_dbscan.py. \
+    If it matches the k-mer matrix, contigs are projected with it instead of doing PCA again (default: k-mer_pca.npz next to the k-mer matrix)')
+parser.add_argument('--pca_mode', help='How PCA is done if there is no PCA model (see recursive_dbscan.py)', \
+    choices=kmer_functions.PCA_MODES, default='auto')
+parser.add_argument('--recruitment_engine', help='batch fits the jackknife classifiers once per iteration and predicts all \
+    unclustered contigs with them, per_contig fits new classifiers for each unclustered contig (slower)', choices=['batch','per_contig'], default='batch')
 args = vars(parser.parse_args())
 
 def round_down(num, divisor):
     return num - (num%divisor)
 
-def revcomp( string ):
-	trans_dict = { 'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C' }
-	complement_list = list()
-
-	for i in range(0, len(string) ):
-		if string[i] in trans_dict:
-			complement_list.append(trans_dict[string[i]])
-		else:
-			return -1
-
-	return ''.join(reversed(complement_list))
-
-def normalizeKmers(count_matrix): # list of lists, not a np matrix
-	# We now remove all the k-mers where all counts are '1'
-	#logger.info('Trimming k-mers')
-	columns_to_delete = dict()
-	for i in range(0, len(unique_k_mers.keys())):
-		non_zero_counts = 0
-		for j in range(0, len(count_matrix)):
-			if count_matrix[j][i] > 1:
-				non_zero_counts += 1
-
-		if non_zero_counts == 0:
-			columns_to_delete[i] = 1
-
-	filtered_contig_k_mer_counts = list()
-	for i in range(0, len(count_matrix)):
-		new_row = list()
-		#unique_k_mers is a global variable
-		for j in range(0, len(unique_k_mers.keys())):
-			if j not in columns_to_delete:
-				new_row.append(count_matrix[i][j])
-		filtered_contig_k_mer_counts.append(new_row)
-
-	# 3. Normalization
-	#logger.info('Normalizing counts')
-
-	k_mer_frequency_matrix = list()
-
-	for count_list in filtered_contig_k_mer_counts:
-		total_count = 0
-		for count in count_list:
-			total_count += count
-
-		normalized_list = list()
-		for count in count_list:
-			normalized_list.append(float(count)/total_count)
-
-		# Now we calculate the Centered log-ratio (CLR) transformation
-		# See Aitchison, J. The Statistical Analysis of Compositional Data (1986) and
-		# Pawlowsky-Glahn, Egozcue, Tolosana-Delgado. Lecture Notes on Compositional Data Analysis (2011)
-		geometric_mean = stats.mstats.gmean(normalized_list)
-		clr_list = list()
-
-		for item in normalized_list:
-			intermediate_value = item / geometric_mean
-			clr_list.append(math.log(intermediate_value))
-
-		k_mer_frequency_matrix.append(clr_list)
-
-	return k_mer_frequency_matrix
-
-def jackknife_training(features,labels):
+def jackknife_training(features,labels,random_state = None):
     #Function to randomly subsample data into halves (hence 0.5), train
     #ML-classifier and make prediction. Used iteratively in
     #calculate_bootstrap_replicates() function (see below)
-    train_features, test_features, train_labels, test_labels = train_test_split(features, labels, test_size = 0.50)
-    my_classifier = tree.DecisionTreeClassifier()
+    train_features, test_features, train_labels, test_labels = train_test_split(features, labels, test_size = 0.50, random_state = random_state)
+    my_classifier = tree.DecisionTreeClassifier(random_state = random_state)
     my_classifier = my_classifier.fit(train_features,train_labels)
     predictions = my_classifier.predict(test_features)
     return my_classifier
 
-def calculate_bootstrap_replicates(feature_array,iterations = 10):
+def matrix_bytes(matrix):
+    #Memory used by a NumPy array or SciPy sparse matrix
+    if sparse.issparse(matrix):
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    return matrix.nbytes
+
+def one_hot_matrix(column):
+    #Sparse int8 matrix with a column for each value of a table column (in sorted order, as pd.get_dummies), and a 1
+    #in each row for its value. Rows with no value (NaN) are all 0
+    codes, values = pd.factorize(column, sort=True)
+    rows = np.flatnonzero(codes >= 0)
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, codes[rows])), shape=(len(codes), len(values)))
+
+def dump_training_data(features,labels,directory):
+    #Writes the training features (float32) and labels (int32) to one file that worker processes memory-map
+    #read-only, so that tasks only carry the path instead of a copy of the training set
+    training_data_path = os.path.join(directory, 'training_data_{}.joblib'.format(len(labels)))
+    joblib.dump((features,labels), training_data_path)
+    return training_data_path
+
+def calculate_bootstrap_replicates(feature_array,training_data_path,iterations = 10):
     prediction_list = []
+    features,labels = joblib.load(training_data_path, mmap_mode='r')
     for i in range(iterations):
-        #Here features and labels are global variables
         jackknifed_classifier = jackknife_training(features,labels)
         ML_prediction = jackknifed_classifier.predict(feature_array)[0]
         prediction_list.append(ML_prediction)
@@ -150,40 +116,53 @@ def calculate_bootstrap_replicates(feature_array,iterations = 10):
     #To see frequency of all prediction: print counter
     return top_prediction,confidence_percent
 
-def redundant_marker_prediction(contig_name,predicted_cluster,pandas_table,cluster_column_name):
+def fit_jackknife_classifiers(features,labels,iterations = 10,processors = 1):
+    #Fits the jackknife classifiers, each in its own worker. Each one gets a seed drawn here, so that the
+    #splits don't depend on which worker fits them
+    seeds = np.random.randint(np.iinfo(np.int32).max, size=iterations)
+    return Parallel(n_jobs = processors)(delayed(jackknife_training)(features, labels, seed) for seed in seeds)
+
+def predict_votes(classifiers,feature_array):
+    #Returns the prediction of each classifier (rows) for each contig (columns)
+    return np.array([ classifier.predict(feature_array) for classifier in classifiers ])
+
+def jackknife_predictions(classifiers,unclustered_features,processors = 1):
+    #Predicts all the unclustered contigs with each of the jackknife classifiers, in chunks of contigs spread
+    #over the workers. Returns the most common prediction for each contig (the first one made if tied, as in
+    #calculate_bootstrap_replicates) and the percentage of classifiers that made it
+    iterations = len(classifiers)
+    num_chunks = max(processors, -(-unclustered_features.shape[0] // prediction_chunk_rows))
+    chunks = np.array_split(np.arange(unclustered_features.shape[0]), num_chunks)
+    votes = np.hstack(Parallel(n_jobs = processors)(delayed(predict_votes)(classifiers, unclustered_features[chunk]) for chunk in chunks if len(chunk)))
+    #The number of classifiers agreeing with each classifier's prediction, for each contig
+    agreement = np.zeros(votes.shape, dtype=np.int32)
+    for i in range(iterations):
+        agreement += (votes == votes[i])
+    top_classifier = np.argmax(agreement, axis=0)
+    contig_indices = np.arange(votes.shape[1])
+    top_predictions = votes[top_classifier, contig_indices]
+    confidence_percents = np.round(agreement[top_classifier, contig_indices]/iterations*100,3)
+    return top_predictions,confidence_percents
+
+def redundant_marker_prediction(contig_PFAMs,cluster_PFAMs):
     #Function to check for redundancy of single copy gene markers in ML
-    #predictions. The way it's written now,
-    #Get a list of PFAM markers from current cluster
-    cluster_df = pandas_table.loc[pandas_table[cluster_column_name] == predicted_cluster]
-    cluster_PFAMs = []
-    for count,contig in enumerate(cluster_df['contig']):
-        #If it's a marker contig
-        if cluster_df['num_single_copies'].iloc[count] > 0:
-            contig_PFAMs = cluster_df['single_copy_PFAMs'].iloc[count].split(",")
-            cluster_PFAMs += contig_PFAMs
-    contig_index = list(pandas_table['contig']).index(contig_name)
-    #contig_df = pandas_table.loc[(pandas_table.contig == contig_name)]
-    redundancy = False
-    is_marker_contig = False
-    #Avoid non-marker contigs in this calculation, for some reason evaluating to floats..
-    if not isinstance(pandas_table.iloc[contig_index]['single_copy_PFAMs'],float):
-        contig_PFAMs = pandas_table['single_copy_PFAMs'][contig_index].split(",")
-        if len(contig_PFAMs) > 0:
-            is_marker_contig = True
-        for PFAM in contig_PFAMs:
-            if PFAM in cluster_PFAMs:
-                redundancy = True
-                #print("-->This prediction adds marker redundancy...skipping...")
-                return redundancy,is_marker_contig
-            else:
-                pass
-    else:
+    #predictions. contig_PFAMs are the markers of the predicted contig (None
+    #if it has none) and cluster_PFAMs the set of markers already in the
+    #predicted cluster (see cluster_marker_index)
+    if contig_PFAMs is None:
         #If no markers, can't add contamination...
-        redundancy = False
-        return redundancy,is_marker_contig
-    #Maybe this update should happen after function return?
-    #pandas_table[cluster_column_name][contig_index] = predicted_cluster
-    return redundancy,is_marker_contig
+        return False,False
+    redundancy = not cluster_PFAMs.isdisjoint(contig_PFAMs)
+    return redundancy,True
+
+def cluster_marker_index(clusters,contig_PFAM_lists):
+    #Returns the set of single copy markers of each cluster, from the cluster
+    #and the markers (see contig_PFAM_lists below) of each contig
+    cluster_PFAMs = collections.defaultdict(set)
+    for cluster,contig_PFAMs in zip(clusters,contig_PFAM_lists):
+        if contig_PFAMs is not None:
+            cluster_PFAMs[cluster].update(contig_PFAMs)
+    return cluster_PFAMs
 
 def calculateClusterStats(pandas_table,cluster_column,life_domain="bacteria"):
     #Function to calculate completeness and contamination of every dbscan
@@ -247,13 +226,8 @@ kingdom = args['kingdom']
 print("Looking for taxonomy info in {}".format(args['contig_tab']))
 use_taxonomy_info = False
 try:
-    phylum_dummy_matrix = pd.get_dummies(contig_table['phylum']).astype(np.int8)
-    class_dummy_matrix = pd.get_dummies(contig_table['class']).astype(np.int8)
-    order_dummy_matrix = pd.get_dummies(contig_table['order']).astype(np.int8)
-    family_dummy_matrix = pd.get_dummies(contig_table['family']).astype(np.int8)
-    genus_dummy_matrix = pd.get_dummies(contig_table['genus']).astype(np.int8)
-    species_dummy_martix = pd.get_dummies(contig_table['species']).astype(np.int8)
-    print("Loaded taxonomy info as dummy matrices...")
+    taxonomy_matrix = sparse.hstack([ one_hot_matrix(contig_table[rank]) for rank in ('phylum','class','order','family','genus','species') ], format='csr')
+    print("Loaded taxonomy info as a sparse one-hot matrix ({} columns)...".format(taxonomy_matrix.shape[1]))
     use_taxonomy_info = True
 except KeyError:
     print("Couldn't find taxonomy info in table. Excluding as training feature...")
@@ -261,55 +235,39 @@ except KeyError:
 #contig_table = "full_table"
 master_table = contig_table
 
-#Define "unique_k_mers"
-# Count K-mer frequencies
-k_mer_size = 5
 matrix_file = args['k_mer_matrix']
-k_mer_dict = dict() # Holds lists of k-mer counts, keyed by contig name
-
-count = 0
-unique_k_mers = dict()
-
-DNA_letters = ['A', 'T', 'C', 'G']
-all_k_mers = list(DNA_letters)
-for i in range(1, k_mer_size):
-	new_list = list()
-	for current_seq in all_k_mers:
-		for char in DNA_letters:
-			new_list.append(current_seq + char)
-	all_k_mers = new_list
-
-# Now we trim k-mers and put them in the dictionary
-for k_mer in all_k_mers:
-	k_mer_reverse = revcomp(k_mer)
-	if (k_mer not in unique_k_mers) and (k_mer_reverse not in unique_k_mers):
-		unique_k_mers[k_mer] = count
-		count += 1
-
-# Now we load the k-mer matrix
+
+# Now we load the k-mer matrix (either the binary or the tsv format)
 print("Loading k-mer matrix...")
-k_mer_dict = {}
-with open(matrix_file) as matrix:
-	for i,line in enumerate(matrix):
-		if i > 0:
-			line_list = line.rstrip().split('\t')
-			contig = line_list.pop(0)
-			line_list = [ int(x) for x in line_list ]
-			k_mer_dict[contig] = line_list
+matrix_contigs, matrix_k_mers, k_mer_matrix = kmer_functions.read_kmer_matrix(matrix_file)
+k_mer_index = {}
+for i,contig in enumerate(matrix_contigs):
+	k_mer_index[contig] = i
 
 # Make normalized k-mer matrix
+# The rows of the contigs are read from the (memory-mapped) matrix in chunks by the PCA, so the counts
+# are never copied into memory as a whole
 print("Normalizing k-mer martix...")
 contig_list = master_table['contig'].tolist()
-k_mer_counts = list()
-for contig in contig_list:
-	k_mer_counts.append(k_mer_dict[contig])
-
-normalized_k_mer_matrix = normalizeKmers(k_mer_counts)
-
-print("Reducing normalized k-mer matrix to 50 dimensions with PCA...")
-# For performance reasons we reduce the dimensions to 50 with PCA
-pca = decomposition.PCA(n_components=50)
-pca_matrix = pca.fit_transform(normalized_k_mer_matrix)
+k_mer_rows = [ k_mer_index[contig] for contig in contig_list ]
+
+# For performance reasons we reduce the dimensions to 50 with PCA. recursive_dbscan.py has
+# already fitted a PCA model to these k-mers, so if it is there we only need to project them
+pca_model_path = args['pca_model'] or os.path.join(os.path.dirname(os.path.abspath(matrix_file)), 'k-mer_pca.npz')
+pca_model = None
+if os.path.isfile(pca_model_path):
+    pca_model = kmer_functions.read_pca_model(pca_model_path, matrix_k_mers)
+    if pca_model is None:
+        print("PCA model {} doesn't match the k-mer matrix, so it won't be used".format(pca_model_path))
+
+pca_start_time = time.time()
+if pca_model is not None:
+    print("Projecting normalized k-mer matrix with the PCA model in {}...".format(pca_model_path))
+    pca_matrix = kmer_functions.apply_pca(k_mer_matrix, pca_model, rows=k_mer_rows)
+else:
+    print("Reducing normalized k-mer matrix to 50 dimensions with PCA...")
+    pca_matrix, pca_model = kmer_functions.fit_pca(k_mer_matrix, 50, args['pca_mode'], k_mer_rows)
+print("PCA took {} seconds".format(round(time.time() - pca_start_time, 2)))
 
 ###For k-kmer matrix reduction - END
 
@@ -318,137 +276,159 @@ processors = int(args['processors'])
 if processors > multiprocessing.cpu_count():
     processors = multiprocessing.cpu_count()
 bootstrap_iterations = int(args['num_iterations'])
+# Unclustered contigs are predicted in chunks of up to this many rows
+prediction_chunk_rows = 10000
 confidence_cutoff = float(args['Confidence_cutoff'])
 if confidence_cutoff % bootstrap_iterations != 0  and len(str(int(confidence_cutoff))) == len(str(bootstrap_iterations)):
     confidence_cutoff = round_down(confidence_cutoff,bootstrap_iterations)
 cluster_column_name = args['cluster_column']
 unclustered_name = args['unclustered_name']
-taxonomy_matrix_dict = {}
 
 #2. Parse vizbin, cov, and taxonomy info in "features" and autometa-defined
 # clusters into "labels" for classifier using appropriate data structure
 print("Loading other features and labels...")
-features = []
-labels = []
-contig_index_dict = {}
-contig_feature_dict = {}
-for count,contig in enumerate(contig_table['contig']):
-    num_markers = contig_table['num_single_copies'][count]
-    num_single_copies = contig_table
-    contig_index_dict[contig] = count
-    bh_tsne_x = contig_table['bh_tsne_x'][count]
-    bh_tsne_y = contig_table['bh_tsne_y'][count]
-    length = contig_table['length'][count]
-    cov = contig_table['cov'][count]
-    gc = contig_table['gc'][count]
-    cluster = contig_table[cluster_column_name][count]
-    contig_feature_dict[contig] = pca_matrix[count].tolist() + [cov]
-    if use_taxonomy_info:
-        tax_phylum = list(phylum_dummy_matrix.iloc[count])
-        tax_class = list(class_dummy_matrix.iloc[count])
-        tax_order = list(order_dummy_matrix.iloc[count])
-        tax_family = list(family_dummy_matrix.iloc[count])
-        tax_genus = list(genus_dummy_matrix.iloc[count])
-        tax_species = list(species_dummy_martix.iloc[count])
-        taxonomy = tax_phylum + tax_class + tax_order + tax_family + tax_genus + tax_species
-        taxonomy_matrix_dict[contig] = taxonomy
-        contig_feature_dict[contig] = pca_matrix[count].tolist() + [cov] + taxonomy
-    if cluster != unclustered_name and num_markers > 0:
-        features.append(contig_feature_dict[contig])
-        labels.append(cluster)
-
-print("There are {} training contigs...".format(len(features)))
+# Features are one float32 matrix, with a row per contig of the contig table: the PCA dimensions and coverage,
+# followed by the taxonomy (as a sparse block) if there is any
+dense_features = np.hstack([ pca_matrix, contig_table['cov'].values.astype(np.float32).reshape(-1, 1) ])
+if use_taxonomy_info:
+    feature_matrix = sparse.hstack([ sparse.csr_matrix(dense_features), taxonomy_matrix ], format='csr', dtype=np.float32)
+else:
+    feature_matrix = dense_features
+del dense_features
+print("Feature matrix: {} contigs x {} features, {} MB".format(feature_matrix.shape[0], feature_matrix.shape[1], round(matrix_bytes(feature_matrix) / 2**20, 2)))
+
+# Rows of the contig table used as training data
+is_training_contig = np.asarray((contig_table[cluster_column_name] != unclustered_name) & (contig_table['num_single_copies'] > 0))
+training_rows = np.flatnonzero(is_training_contig).tolist()
+labels = contig_table[cluster_column_name][is_training_contig].tolist()
+
+# Single copy markers of each contig, None for contigs without any (their single_copy_PFAMs are read as NaN)
+contig_PFAM_lists = []
+for num_markers,PFAMs in zip(contig_table['num_single_copies'],contig_table['single_copy_PFAMs']):
+    if num_markers > 0 and not isinstance(PFAMs,float):
+        contig_PFAM_lists.append(PFAMs.split(","))
+    else:
+        contig_PFAM_lists.append(None)
+
+print("There are {} training contigs...".format(len(training_rows)))
+
+# With the per_contig engine, training data is memory-mapped by the worker processes from here. It is
+# removed however the loop ends, so that it isn't left in the output directory
+training_data_dir = None
+if args['recruitment_engine'] == 'per_contig':
+    training_data_dir = tempfile.mkdtemp(prefix='ML_recruitment_', dir=os.path.dirname(os.path.abspath(args['out_table'])))
 
 num_confident_predictions = 1
 num_markers_classifed = 1
 iteration = 0
-while num_markers_classifed > 0:
-    classified_marker_list = []
-    iteration_start_time = time.time()
-    ML_predictions_dict = {}
-    ML_recruitment_list = []
-    recruited_sequence_length = 0
-    accurate_prediction_list = []
-    temp_contig_table = contig_table.copy(deep=True)
-    #Recruit unclustered sequences
-    if iteration > 0:
-        cluster_column_name = "ML_expanded_clustering"
-    num_unclustered_contigs = contig_table[cluster_column_name].tolist().count(unclustered_name)
-    unclustered_contig_feature_list = []
-    unclustered_contig_list = []
-    print("Recruiting {} unclustered sequences with {} training contigs. This could take a while...".format(num_unclustered_contigs,len(features)))
-
-    #Prepare unclustered contig feature array
-    for count,contig in enumerate(contig_table['contig']):
-        single_np_array = np.array([contig_feature_dict[contig]])
-        contig_length = contig_table.iloc[count]['length']
-        #After the first iteration, train from previous confident predictions
-        cluster = contig_table.iloc[count][cluster_column_name]
-
-        #If contig is unclustered, prepare feature array for (multiproccesed) ML prediction
-        if cluster == unclustered_name:
-            unclustered_contig_feature_list.append(single_np_array)
-            unclustered_contig_list.append(contig)
-            ML_recruitment_list.append(unclustered_name)
-
-        #I think the index of the list is getting messed up by this, actually. Maybe store index and cluster assingment in separate df
-        else:
-            ML_recruitment_list.append(cluster)
-
-    #START - Multiprocess subroutine
-    multiprocessed_output = Parallel(n_jobs = processors)(delayed(calculate_bootstrap_replicates)(features, bootstrap_iterations) for unclustered_features in unclustered_contig_feature_list)
-    #END - Multiprocess subroutine
-    for count,output_tuple in enumerate(multiprocessed_output):
-        #Assuming index (from multiprocessing) is preserved
-        contig = unclustered_contig_list[count]
-        ML_prediction,confidence = output_tuple
-        ML_predictions_dict[contig] = ML_prediction,confidence
-        #print("ML predictions and jackknife confidence for contig {}: {},{}".format(contig, ML_prediction,confidence))
-        #If it the prediction passes confidence cutoff
-        #Could also look for redundant markers...
-        redundant,is_marker_contig = redundant_marker_prediction(contig,ML_prediction,temp_contig_table,cluster_column_name)
-        global_contig_index = contig_index_dict[contig]
-        if confidence >= confidence_cutoff and not redundant:
-            print("ML predictions and jackknife confidence for contig {}: {},{}".format(contig, ML_prediction,confidence))
-            #Add prediction to ML_recruitment_list/replace with updated label
-            #ML_recruitment_list.append(ML_prediction)
-            ML_recruitment_list[global_contig_index] = ML_prediction
-            accurate_prediction_list.append(ML_prediction)
-            recruited_sequence_length += contig_length
-            #Update contig table, so that any markers added to the cluster will
-            #be considered in the next check of marker redundancy
-            temp_contig_table[cluster_column_name].iloc[count] = ML_prediction
-
-            #Update training data with any confident and non-redundant marker contig classifications
-            if is_marker_contig:
-                features.append(contig_feature_dict[contig])
-                labels.append(ML_prediction)
-                classified_marker_list.append(ML_prediction)
+try:
+    while num_markers_classifed > 0:
+        classified_marker_list = []
+        iteration_start_time = time.time()
+        ML_predictions_dict = {}
+        recruited_sequence_length = 0
+        accurate_prediction_list = []
+        #Recruit unclustered sequences
+        if iteration > 0:
+            cluster_column_name = "ML_expanded_clustering"
+        #Markers of each cluster, updated with the markers of contigs recruited to it
+        cluster_PFAMs = cluster_marker_index(contig_table[cluster_column_name],contig_PFAM_lists)
+        num_unclustered_contigs = contig_table[cluster_column_name].tolist().count(unclustered_name)
+        print("Recruiting {} unclustered sequences with {} training contigs. This could take a while...".format(num_unclustered_contigs,len(training_rows)))
+
+        # Training features are the training rows of the feature matrix and cluster labels are encoded as int32 codes
+        training_features = feature_matrix[training_rows]
+        label_names, training_labels = np.unique(labels, return_inverse=True)
+        training_labels = training_labels.astype(np.int32)
+
+        #After the first iteration, train from previous confident predictions. Unclustered contigs are predicted
+        #with (multiproccesed) ML prediction, the others keep their cluster
+        ML_recruitment_list = contig_table[cluster_column_name].tolist()
+        unclustered_rows = np.flatnonzero(np.asarray(contig_table[cluster_column_name] == unclustered_name))
+        unclustered_features = feature_matrix[unclustered_rows]
+
+        if args['recruitment_engine'] == 'batch':
+            if len(unclustered_rows):
+                fit_start_time = time.time()
+                jackknifed_classifiers = fit_jackknife_classifiers(training_features, training_labels, bootstrap_iterations, processors)
+                predict_start_time = time.time()
+                top_predictions,confidence_percents = jackknife_predictions(jackknifed_classifiers, unclustered_features, processors)
+                jackknife_timing = ". Jackknife fit,predict: {},{} seconds".format(round(predict_start_time - fit_start_time, 2), round(time.time() - predict_start_time, 2))
+                multiprocessed_output = list(zip(top_predictions.tolist(), confidence_percents.tolist()))
+            else:
+                multiprocessed_output = []
+                jackknife_timing = ""
         else:
-            #ML_recruitment_list.append(unclustered_name)
-            ML_recruitment_list[global_contig_index] = unclustered_name
-
-    num_predictions = len(multiprocessed_output)
-    num_confident_predictions = len(accurate_prediction_list)
-    num_markers_classifed = len(classified_marker_list)
-    #Calculate average cluster stats
-    cluster_stats_dict = calculateClusterStats(contig_table,cluster_column_name,kingdom)
-    completeness_list = []
-    purity_list = []
-    for cluster,info_dictionary in cluster_stats_dict.items():
-        completeness_list.append(info_dictionary['completeness'])
-        purity_list.append(info_dictionary['purity'])
-    mean_completeness = round(np.mean(completeness_list),1)
-    mean_purity = round(np.mean(purity_list),1)
-    elapsed_time = time.strftime('%H:%M:%S', time.gmtime(round((time.time() - iteration_start_time),2)))
-    print("{} ({} marker contigs) of {} predictions ({} bp) were {}% confident and non-redundant for iteration {} in {} (HH:MM:SS). Mean completeness,purity: {},{}"\
-        .format(num_confident_predictions,num_markers_classifed,num_predictions,recruited_sequence_length,confidence_cutoff,iteration,elapsed_time,mean_completeness,mean_purity))
-
-    contig_table['ML_expanded_clustering'] = ML_recruitment_list
-    #Break after first iteration if recursive option not specified:
-    if not args['recursive']:
-        break
-    iteration += 1
+            training_data_path = dump_training_data(training_features, training_labels, training_data_dir)
+            # Measure what each task costs to send to a worker process
+            task_bytes = 0
+            pickle_start_time = time.time()
+            for row in range(len(unclustered_rows)):
+                task_bytes += len(pickle.dumps((unclustered_features[row:row + 1], training_data_path, bootstrap_iterations), pickle.HIGHEST_PROTOCOL))
+            pickle_time = time.time() - pickle_start_time
+            training_bytes = matrix_bytes(training_features) + training_labels.nbytes
+            if len(unclustered_rows):
+                print("Task payload: {} bytes on average ({} seconds to pickle all {} tasks), training data ({} bytes) is memory-mapped from {}"\
+                    .format(task_bytes // len(unclustered_rows), round(pickle_time, 4), len(unclustered_rows), training_bytes, training_data_path))
+
+            #START - Multiprocess subroutine
+            multiprocessed_output = Parallel(n_jobs = processors)(delayed(calculate_bootstrap_replicates)(unclustered_features[row:row + 1], training_data_path, bootstrap_iterations) for row in range(len(unclustered_rows)))
+            #END - Multiprocess subroutine
+            jackknife_timing = ""
+        for count,output_tuple in enumerate(multiprocessed_output):
+            #Assuming index (from multiprocessing) is preserved
+            global_contig_index = unclustered_rows[count]
+            contig = contig_table['contig'][global_contig_index]
+            label_code,confidence = output_tuple
+            ML_prediction = label_names[label_code]
+            ML_predictions_dict[contig] = ML_prediction,confidence
+            #print("ML predictions and jackknife confidence for contig {}: {},{}".format(contig, ML_prediction,confidence))
+            #If it the prediction passes confidence cutoff
+            #Could also look for redundant markers...
+            redundant,is_marker_contig = redundant_marker_prediction(contig_PFAM_lists[global_contig_index],cluster_PFAMs[ML_prediction])
+            if confidence >= confidence_cutoff and not redundant:
+                print("ML predictions and jackknife confidence for contig {}: {},{}".format(contig, ML_prediction,confidence))
+                #Add prediction to ML_recruitment_list/replace with updated label
+                #ML_recruitment_list.append(ML_prediction)
+                ML_recruitment_list[global_contig_index] = ML_prediction
+                accurate_prediction_list.append(ML_prediction)
+                recruited_sequence_length += contig_table['length'][global_contig_index]
+                #Add the contig's markers to the cluster, so that they will be
+                #considered in the next check of marker redundancy, and update
+                #training data with any confident and non-redundant marker contig classifications
+                if is_marker_contig:
+                    cluster_PFAMs[ML_prediction].update(contig_PFAM_lists[global_contig_index])
+                    training_rows.append(global_contig_index)
+                    labels.append(ML_prediction)
+                    classified_marker_list.append(ML_prediction)
+            else:
+                #ML_recruitment_list.append(unclustered_name)
+                ML_recruitment_list[global_contig_index] = unclustered_name
+
+        num_predictions = len(multiprocessed_output)
+        num_confident_predictions = len(accurate_prediction_list)
+        num_markers_classifed = len(classified_marker_list)
+        #Calculate average cluster stats
+        cluster_stats_dict = calculateClusterStats(contig_table,cluster_column_name,kingdom)
+        completeness_list = []
+        purity_list = []
+        for cluster,info_dictionary in cluster_stats_dict.items():
+            completeness_list.append(info_dictionary['completeness'])
+            purity_list.append(info_dictionary['purity'])
+        mean_completeness = round(np.mean(completeness_list),1)
+        mean_purity = round(np.mean(purity_list),1)
+        elapsed_time = time.strftime('%H:%M:%S', time.gmtime(round((time.time() - iteration_start_time),2)))
+        print("{} ({} marker contigs) of {} predictions ({} bp) were {}% confident and non-redundant for iteration {} in {} (HH:MM:SS). Mean completeness,purity: {},{}{}"\
+            .format(num_confident_predictions,num_markers_classifed,num_predictions,recruited_sequence_length,confidence_cutoff,iteration,elapsed_time,mean_completeness,mean_purity,jackknife_timing))
+
+        contig_table['ML_expanded_clustering'] = ML_recruitment_list
+        #Break after first iteration if recursive option not specified:
+        if not args['recursive']:
+            break
+        iteration += 1
+finally:
+    if training_data_dir is not None:
+        shutil.rmtree(training_data_dir, ignore_errors=True)
 
 elapsed_time = time.strftime('%H:%M:%S', time.gmtime(round((time.time() - start_time),2)))
 print("Done! Total elapsed time = {} (HH:MM:SS)".format(elapsed_time))
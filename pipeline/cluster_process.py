@@ -23,7 +23,7 @@ from __future__ import division
 import argparse
 import os
 import pandas as pd
-from Bio import SeqIO
+import fasta_functions
 import subprocess
 import math
 
@@ -43,17 +43,17 @@ def run_command(command_string, stdout_path = None):
 		print('failed, with exit code ' + str(exit_code))
 		exit(1)
 
-def assess_assembly(seq_record_list):
-	assembly_size = sum(len(seq) for seq in seq_record_list)
-	number_of_sequences = len(seq_record_list)
-	sorted_seqs = sorted(seq_record_list, key=len)
-	largest_sequence_length = len(sorted_seqs[-1])
+def assess_assembly(sequence_lengths):
+	assembly_size = sum(sequence_lengths)
+	number_of_sequences = len(sequence_lengths)
+	sorted_lengths = sorted(sequence_lengths)
+	largest_sequence_length = sorted_lengths[-1]
 	sequence_total = 0
 	n50 = None
-	for i,seq_object in enumerate(sorted_seqs):
-		sequence_total += len(seq_object)
+	for i,sequence_length in enumerate(sorted_lengths):
+		sequence_total += sequence_length
 		if sequence_total > (float(assembly_size)/2):
-			n50 = len(seq_object)
+			n50 = sequence_length
 			break
 	return { 'size': assembly_size, 'number_sequences': number_of_sequences, 'largest_sequence': largest_sequence_length, 'n50': n50 }
 
@@ -146,10 +146,10 @@ for i,row in master_table.iterrows():
 		else:
 			markers_in_cluster[cluster][pfam] += 1
 
-# Load fasta file using biopython, and split into clusters
-cluster_sequences = dict() # Keyed by cluster, will hold lists of seq objects
-for seq_record in SeqIO.parse(fasta_path, 'fasta'):
-	seq_name = str(seq_record.id)
+# Index fasta file and split into clusters, sequences are only read from disk as they are written out
+fasta_index = fasta_functions.FastaIndex(fasta_path)
+cluster_sequences = dict() # Keyed by cluster, will hold lists of sequence names
+for seq_name in fasta_index:
 	if seq_name in cluster_contigs:
 		cluster = cluster_contigs[seq_name]
 	else:
@@ -157,7 +157,7 @@ for seq_record in SeqIO.parse(fasta_path, 'fasta'):
 
 	if cluster not in cluster_sequences:
 		cluster_sequences[cluster] = list()
-	cluster_sequences[cluster].append(seq_record)
+	cluster_sequences[cluster].append(seq_name)
 
 # Output summary table plus individual fasta files
 summary_table_path = output_dir + '/cluster_summary_table'
@@ -165,7 +165,7 @@ summary_table = open(summary_table_path, 'w')
 summary_table.write('cluster\tsize\tlongest_contig\tn50\tnumber_contigs\tcompleteness\tpurity\tav_cov\tav_gc\n')
 
 for cluster in cluster_sequences:
-	attributes = assess_assembly(cluster_sequences[cluster])
+	attributes = assess_assembly([ fasta_index.length(seq_name) for seq_name in cluster_sequences[cluster] ])
 	total_size = attributes['size']
 	longest_contig = attributes['largest_sequence']
 	n50 = attributes['n50']
@@ -194,8 +194,7 @@ for cluster in cluster_sequences:
 	# Calculate average GC and cov, weighted by sequence length
 	weighted_gc_av = 0.0
 	weighted_cov_av = 0.0
-	for seq_record in cluster_sequences[cluster]:
-		seq_name = str(seq_record.id)
+	for seq_name in cluster_sequences[cluster]:
 		seq_length = contig_info[seq_name]['length']
 		seq_gc = contig_info[seq_name]['gc']
 		seq_cov = contig_info[seq_name]['cov']
@@ -209,7 +208,9 @@ for cluster in cluster_sequences:
 
 	# Write individual fasta file
 	fasta_output_path = output_dir + '/cluster_' + cluster + '.fasta'
-	SeqIO.write(cluster_sequences[cluster], fasta_output_path, 'fasta')
+	with open(fasta_output_path, 'wb') as fasta_output:
+		for seq_name in cluster_sequences[cluster]:
+			fasta_functions.write_fasta(fasta_output, fasta_index.header(seq_name), fasta_index.fetch(seq_name))
 
 summary_table.close()
 
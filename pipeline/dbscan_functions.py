@@ -0,0 +1,352 @@
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Clustering used by recursive_dbscan.py
+# DBSCAN with min_samples=1 has no noise points, and two points end up in the same cluster when they
+# are joined by a chain of points less than eps apart - which is single-linkage clustering cut at eps.
+# So the clusters for every eps of a sweep can be read from one minimum spanning tree (MST)
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import Delaunay
+from scipy.spatial.distance import pdist, squareform
+
+try:
+    from scipy.spatial import QhullError
+except ImportError:
+    from scipy.spatial.qhull import QhullError
+
+# Below this many points the MST is taken from all pairwise distances rather than a Delaunay triangulation
+PAIRWISE_MST_POINTS = 1000
+
+def spanning_tree_edges(points):
+    "Returns the edges (i, j, distance) of a Euclidean minimum spanning tree of points with no duplicates"
+    num_points, dimensions = points.shape
+    if num_points < 2:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+
+    graph = None
+    if num_points > max(PAIRWISE_MST_POINTS, dimensions + 1):
+        # The MST is a subgraph of the Delaunay triangulation, which has O(n) edges in 2 or 3 dimensions
+        try:
+            triangulation = Delaunay(points)
+        except QhullError:
+            # Degenerate inputs (for instance all points on a line) can't be triangulated as they are,
+            # so qhull is asked to joggle them
+            triangulation = Delaunay(points, qhull_options='QJ')
+        simplices = triangulation.simplices
+        vertices = simplices.shape[1]
+        rows = np.concatenate([ simplices[:, a] for a in range(vertices) for b in range(a + 1, vertices) ])
+        columns = np.concatenate([ simplices[:, b] for a in range(vertices) for b in range(a + 1, vertices) ])
+        # Edges shared by neighbouring simplices are only kept once
+        graph = sparse.csr_matrix((np.ones(len(rows)), (np.minimum(rows, columns), np.maximum(rows, columns))), shape=(num_points, num_points))
+        rows = np.repeat(np.arange(num_points), np.diff(graph.indptr))
+        graph.data = np.sqrt(((points[rows] - points[graph.indices]) ** 2).sum(axis=1))
+    else:
+        graph = squareform(pdist(points))
+
+    tree = csgraph.minimum_spanning_tree(graph).tocoo()
+    return tree.row.astype(np.intp), tree.col.astype(np.intp), tree.data
+
+class SingleLinkageSweep(object):
+    "DBSCAN (min_samples=1) labels of a set of points for increasing values of eps, from one MST"
+
+    def __init__(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        self.num_points = len(points)
+
+        # Coincident points (which qhull would leave out) join their first copy at distance 0
+        unique_points, first_rows, inverse = np.unique(points, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        rows, columns, distances = spanning_tree_edges(unique_points)
+        duplicates = np.flatnonzero(first_rows[inverse] != np.arange(self.num_points))
+
+        rows = np.concatenate([first_rows[rows], first_rows[inverse[duplicates]]])
+        columns = np.concatenate([first_rows[columns], duplicates])
+        distances = np.concatenate([distances, np.zeros(len(duplicates))])
+        order = np.argsort(distances, kind='mergesort')
+        self.edge_rows = rows[order]
+        self.edge_columns = columns[order]
+        self.edge_distances = distances[order]
+
+        self.reset()
+
+    def reset(self):
+        self.parent = np.arange(self.num_points)
+        self.edges_joined = 0
+        self.eps = None
+
+    def find(self, point):
+        parent = self.parent
+        while parent[point] != point:
+            parent[point] = parent[parent[point]]
+            point = parent[point]
+        return point
+
+    def join(self, eps):
+        "Merges the clusters joined by MST edges no longer than eps (as DBSCAN counts neighbours at distance <= eps)"
+        if self.eps is not None and eps < self.eps:
+            self.reset()
+        end = np.searchsorted(self.edge_distances, eps, side='right')
+        for edge in range(self.edges_joined, end):
+            root_a = self.find(self.edge_rows[edge])
+            root_b = self.find(self.edge_columns[edge])
+            if root_a != root_b:
+                self.parent[max(root_a, root_b)] = min(root_a, root_b)
+        self.edges_joined = max(end, self.edges_joined)
+        self.eps = eps
+
+    def number_of_clusters(self, eps):
+        "Returns the number of clusters at eps - each MST edge no longer than eps merges two of them"
+        return self.num_points - np.searchsorted(self.edge_distances, eps, side='right')
+
+    def single_cluster_eps(self):
+        "Returns the smallest eps at which all the points are in one cluster"
+        if not len(self.edge_distances):
+            return 0.0
+        return self.edge_distances[-1]
+
+    def labels(self, eps):
+        "Returns cluster labels at eps, numbered in order of the first point of each cluster (as sklearn's DBSCAN does)"
+        self.join(eps)
+        # Point every point straight at its root
+        roots = self.parent
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        self.parent = roots
+        # Roots are always the lowest point of their cluster, so ranking the roots numbers clusters by first point
+        is_root = roots == np.arange(self.num_points)
+        cluster_numbers = np.cumsum(is_root) - 1
+        return cluster_numbers[roots]
+
+class MarkerCounts(object):
+    "Sparse contig x marker (PFAM) matrix of single copy marker counts, made once from a dict of dicts keyed by contig and PFAM"
+
+    def __init__(self, contigs, contig_markers):
+        self.rows = dict() # Row of each contig, keyed by contig name
+        self.markers = sorted(set(pfam for markers in contig_markers.values() for pfam in markers))
+        marker_columns = dict((pfam, column) for column, pfam in enumerate(self.markers))
+        rows = list()
+        columns = list()
+        counts = list()
+        for row, contig in enumerate(contigs):
+            self.rows[contig] = row
+            for pfam, count in contig_markers.get(contig, dict()).items():
+                rows.append(row)
+                columns.append(marker_columns[pfam])
+                counts.append(count)
+        self.matrix = sparse.csr_matrix((np.array(counts, dtype=np.int32), (rows, columns)), shape=(len(self.rows), len(self.markers)))
+
+    def subset(self, contigs):
+        "Returns the rows of the matrix for contigs, in order"
+        return self.matrix[[ self.rows[contig] for contig in contigs ]]
+
+def cluster_marker_counts(marker_matrix, labels):
+    "Returns the clusters (sorted labels), and the number of different markers and of single copy markers found in each"
+    clusters, label_codes = np.unique(labels, return_inverse=True)
+    label_codes = label_codes.ravel()
+    # Summing the marker counts of each cluster is a product with the cluster x contig membership matrix
+    membership = sparse.csr_matrix((np.ones(len(label_codes), dtype=np.int32), (label_codes, np.arange(len(label_codes)))),
+        shape=(len(clusters), len(label_codes)))
+    cluster_totals = membership.dot(marker_matrix).tocsr()
+    cluster_totals.eliminate_zeros()
+    unique_markers = np.diff(cluster_totals.indptr)
+    single_copy = cluster_totals.copy()
+    single_copy.data = (single_copy.data == 1).astype(np.int32)
+    single_copy_markers = np.asarray(single_copy.sum(axis=1)).ravel()
+    return clusters, unique_markers, single_copy_markers
+
+GOLDEN_RATIO = (1 + 5 ** 0.5) / 2
+
+def adaptive_eps_search(score, number_of_clusters, eps_min, eps_max, budget):
+    """Returns the eps with the best score (the largest eps if there is a tie) and the number of evaluations of score.
+    A geometric grid over [eps_min, eps_max] brackets the best score, then golden-section steps refine it within
+    the bracket. Values of eps giving the same number of clusters give the same clusters, so they are scored once"""
+    scores = dict() # (eps, score) keyed by number of clusters
+
+    def evaluate(eps):
+        clusters = number_of_clusters(eps)
+        if clusters not in scores:
+            scores[clusters] = (eps, score(eps))
+        return scores[clusters][1]
+
+    if eps_max <= eps_min:
+        grid = [eps_min]
+    else:
+        grid_points = max(3, budget // 2)
+        grid = [ eps_min * (float(eps_max) / eps_min) ** (i / float(grid_points - 1)) for i in range(grid_points) ]
+    grid_scores = [ evaluate(eps) for eps in grid ]
+    best = max(i for i in range(len(grid)) if grid_scores[i] == max(grid_scores))
+
+    lower = grid[max(best - 1, 0)]
+    upper = grid[min(best + 1, len(grid) - 1)]
+    # Stop when the budget is spent, or when there are no clusterings between the ends of the bracket left to try
+    while len(scores) < budget and number_of_clusters(lower) - number_of_clusters(upper) > 1:
+        evaluations = len(scores)
+        width = (upper - lower) / GOLDEN_RATIO
+        left_eps = upper - width
+        right_eps = lower + width
+        if evaluate(left_eps) > evaluate(right_eps):
+            upper = right_eps
+        else:
+            lower = left_eps
+        if len(scores) == evaluations and upper - lower < 1e-9 * max(upper, 1.0):
+            break
+
+    best_score = max(score for eps, score in scores.values())
+    best_eps = max(eps for eps, score in scores.values() if score == best_score)
+    return best_eps, len(scores)
+
+def linear_schedule_length(number_of_clusters, eps_min=0.3, step=0.1):
+    "Returns the number of eps values the linear schedule of runDBSCANs tries before reaching one cluster (ignoring its early stops)"
+    clusters_seen = dict()
+    evaluations = 0
+    eps = eps_min
+    clusters = float('inf')
+    while clusters > 1:
+        clusters = number_of_clusters(eps)
+        evaluations += 1
+        clusters_seen[clusters] = clusters_seen.get(clusters, 0) + 1
+        if clusters_seen[clusters] > 10:
+            step = step * 10
+        eps = eps + step
+    return evaluations
+
+def binning_fingerprint(arrays, parameters):
+    "Returns the hex SHA-1 digest of the arrays and parameters that recursive binning depends on, to check checkpoints against"
+    fingerprint = hashlib.sha1()
+    for array in arrays:
+        array = np.asarray(array)
+        if array.dtype.kind in 'OSU':
+            # Strings (such as contig names) are hashed by value
+            fingerprint.update('\n'.join([ str(value) for value in array ]).encode('utf-8'))
+        else:
+            fingerprint.update(str(array.dtype).encode('utf-8'))
+            fingerprint.update(np.ascontiguousarray(array).tobytes())
+    fingerprint.update('\t'.join([ str(parameter) for parameter in parameters ]).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def write_checkpoint(path, state):
+    "Pickles state to path, through a temporary file so that an interrupted write leaves the last checkpoint in place"
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as checkpoint_file:
+        pickle.dump(state, checkpoint_file, protocol=2)
+    os.rename(temporary_path, path)
+
+def read_checkpoint(path):
+    "Returns the state pickled by write_checkpoint, or None if there is no checkpoint at path"
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as checkpoint_file:
+        return pickle.load(checkpoint_file)
+
+class CondensedTree(object):
+    """HDBSCAN condensed cluster tree of a set of points, with min_samples=1 (so mutual reachability is Euclidean
+    distance and the hierarchy is the single-linkage tree from the MST). A split of the hierarchy is a split of
+    a cluster when both sides have at least min_cluster_size points, otherwise the smaller side falls out of it"""
+
+    def __init__(self, points, min_cluster_size=5, sweep=None):
+        sweep = sweep or SingleLinkageSweep(points)
+        num_points = sweep.num_points
+        num_merges = len(sweep.edge_distances)
+
+        # Single-linkage dendrogram: merge k makes node num_points + k from the two nodes joined by the kth shortest MST edge
+        children = np.zeros((num_merges, 2), dtype=np.intp)
+        sizes = np.ones(num_points + num_merges, dtype=np.intp)
+        parent = np.arange(num_points)
+        node_of_root = np.arange(num_points)
+        for merge in range(num_merges):
+            roots = []
+            for point in (sweep.edge_rows[merge], sweep.edge_columns[merge]):
+                while parent[point] != point:
+                    parent[point] = parent[parent[point]]
+                    point = parent[point]
+                roots.append(point)
+            root_a, root_b = roots
+            children[merge] = node_of_root[root_a], node_of_root[root_b]
+            sizes[num_points + merge] = sizes[node_of_root[root_a]] + sizes[node_of_root[root_b]]
+            parent[root_b] = root_a
+            node_of_root[root_a] = num_points + merge
+        root = num_points + num_merges - 1 if num_points else None
+
+        # Order the points so that the points under each node are a contiguous run starting at node_start
+        self.point_order = np.zeros(num_points, dtype=np.intp)
+        node_start = np.zeros(num_points + num_merges, dtype=np.intp)
+        position = 0
+        stack = [root] if num_points else []
+        while stack:
+            node = stack.pop()
+            node_start[node] = position
+            if node < num_points:
+                self.point_order[position] = node
+                position += 1
+            else:
+                stack.append(children[node - num_points][1])
+                stack.append(children[node - num_points][0])
+
+        # Condensed clusters, as (first position in point_order, number of points, child clusters)
+        self.clusters = list()
+        if not num_points:
+            return
+        pending = [(root, None)]
+        while pending:
+            node, parent_cluster = pending.pop()
+            cluster = len(self.clusters)
+            self.clusters.append((node_start[node], sizes[node], list()))
+            if parent_cluster is not None:
+                self.clusters[parent_cluster][2].append(cluster)
+            # Follow the cluster down the dendrogram until it splits into two large enough parts, or runs out
+            while node >= num_points:
+                left, right = children[node - num_points]
+                large_left = sizes[left] >= min_cluster_size
+                large_right = sizes[right] >= min_cluster_size
+                if large_left and large_right:
+                    pending.append((right, cluster))
+                    pending.append((left, cluster))
+                    break
+                elif large_left:
+                    node = left
+                elif large_right:
+                    node = right
+                else:
+                    break
+
+    def cluster_points(self, cluster):
+        "Returns the points of a condensed cluster"
+        start, size, child_clusters = self.clusters[cluster]
+        return self.point_order[start:start + size]
+
+    def select_clusters(self, accept):
+        "Returns the highest clusters in the tree for which accept(points) is True, going down from the root, as arrays of points"
+        selected = list()
+        pending = [0] if self.clusters else []
+        while pending:
+            cluster = pending.pop(0)
+            points = self.cluster_points(cluster)
+            if accept(points):
+                selected.append(points)
+            else:
+                pending.extend(self.clusters[cluster][2])
+        return selected
@@ -0,0 +1,107 @@
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Two dimensional embeddings of k-mer features, used by recursive_dbscan.py
+# bhsne is the Barnes-Hut t-SNE of the tsne package used by earlier versions. fftsne (FFT-accelerated
+# interpolation t-SNE, from the openTSNE package) and umap (from the umap-learn package) are optional
+
+import hashlib
+import os
+
+import numpy as np
+
+try:
+    from tsne import bh_sne
+except ImportError:
+    bh_sne = None
+
+try:
+    import openTSNE
+except ImportError:
+    openTSNE = None
+
+try:
+    import umap
+except ImportError:
+    umap = None
+
+EMBEDDING_METHODS = ['bhsne', 'fftsne', 'umap']
+EMBEDDING_PACKAGES = { 'bhsne': 'tsne', 'fftsne': 'openTSNE', 'umap': 'umap-learn' }
+
+def is_available(method):
+    "Returns True if the package needed for an embedding method can be imported"
+    backends = { 'bhsne': bh_sne, 'fftsne': openTSNE, 'umap': umap }
+    return backends[method] is not None
+
+def embed(features, method='bhsne', perplexity=30.0, threads=1, seed=None):
+    "Returns the 2D embedding of a feature matrix as an (n, 2) float64 array"
+    if not is_available(method):
+        raise ImportError('The {} embedding needs the {} package'.format(method, EMBEDDING_PACKAGES[method]))
+
+    if method == 'bhsne':
+        # Single threaded, and the input has to be float64
+        features = np.ascontiguousarray(features, dtype=np.float64)
+        return bh_sne(features, d=2, perplexity=perplexity, theta=0.5, random_state=seed)
+
+    if method == 'fftsne':
+        tsne = openTSNE.TSNE(n_components=2, perplexity=perplexity, negative_gradient_method='fft', n_jobs=threads,
+            random_state=seed)
+        return np.asarray(tsne.fit(np.asarray(features, dtype=np.float64)), dtype=np.float64)
+
+    # UMAP's neighbourhood size plays the part of the perplexity. Note - umap-learn runs single threaded
+    # when given a seed, as its parallel optimization isn't reproducible
+    n_neighbors = max(2, min(int(perplexity), len(features) - 1))
+    reducer = umap.UMAP(n_components=2, n_neighbors=n_neighbors, random_state=seed, n_jobs=threads if seed is None else 1)
+    return np.asarray(reducer.fit_transform(np.asarray(features, dtype=np.float32)), dtype=np.float64)
+
+# Bump this when a change to k-mer normalization, PCA or the embeddings would change cached coordinates
+EMBEDDING_CACHE_VERSION = 2
+
+def embedding_key(contigs, sequence_hashes, method, k_mer_size, pca_dimensions, perplexity, seed, pca_mode='auto'):
+    "Returns the hex SHA-1 digest identifying an embedding of the given contigs (in order) and parameters"
+    key = hashlib.sha1()
+    parameters = [EMBEDDING_CACHE_VERSION, method, k_mer_size, pca_dimensions, repr(float(perplexity)), seed, pca_mode]
+    key.update('\t'.join([ str(parameter) for parameter in parameters ]).encode('utf-8'))
+    # Sequence hashes stand in for the k-mer counts, so a contig renamed or changed between assemblies gets a new key
+    for contig, sequence_hash in zip(contigs, sequence_hashes):
+        key.update('\n{}\t{}'.format(contig, sequence_hash).encode('utf-8'))
+    return key.hexdigest()
+
+def embedding_cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key + '.npy')
+
+def pca_model_cache_path(cache_dir, key):
+    "Path of the PCA model (see kmer_functions.write_pca_model) fitted for the embedding named by key"
+    return os.path.join(cache_dir, key + '.pca.npz')
+
+def read_cached_embedding(cache_dir, key):
+    "Returns cached (n, 2) float32 coordinates, or None if there are none for the key"
+    cache_path = embedding_cache_path(cache_dir, key)
+    if not os.path.isfile(cache_path):
+        return None
+    return np.load(cache_path)
+
+def write_cached_embedding(cache_dir, key, coordinates):
+    "Stores coordinates as a float32 .npy file named by key"
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cache_path = embedding_cache_path(cache_dir, key)
+    # Write to a temporary file first so that an interrupted run can't leave a corrupt cache entry
+    temporary_path = cache_path + '.tmp'
+    with open(temporary_path, 'wb') as cache_file:
+        np.save(cache_file, np.asarray(coordinates, dtype=np.float32))
+    os.rename(temporary_path, cache_path)
@@ -0,0 +1,198 @@
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Lightweight fasta reading that does not hold the whole assembly in memory
+# Sequences are handled as bytes, and record names are the first word of the header line (as
+# SeqRecord.id in Biopython)
+
+import os
+
+def to_str(value):
+    "Returns bytes read from a file as str (unchanged in python 2)"
+    if isinstance(value, str):
+        return value
+    return value.decode('utf-8')
+
+def record_name(header):
+    "Returns the name of a record from its header line (without the '>')"
+    header_words = header.split(None, 1)
+    return to_str(header_words[0]) if header_words else ''
+
+def read_fasta(path, full_header=False):
+    "Yields (name, sequence) for each record of a fasta file, one record at a time. Yields the whole header if full_header"
+    with open(path, 'rb') as fasta:
+        header = None
+        sequence_lines = list()
+        for line in fasta:
+            if line.startswith(b'>'):
+                if header is not None:
+                    yield header, b''.join(sequence_lines)
+                header = line[1:].strip()
+                header = to_str(header) if full_header else record_name(header)
+                sequence_lines = list()
+            elif header is not None:
+                sequence_lines.append(line.strip())
+        if header is not None:
+            yield header, b''.join(sequence_lines)
+
+def write_fasta(handle, header, sequence, line_width=60):
+    "Writes one record to a fasta file opened in binary mode, wrapping lines as SeqIO.write does. Returns the bytes written"
+    if not isinstance(header, bytes):
+        header = header.encode('utf-8')
+    handle.write(b'>' + header + b'\n')
+    for start in range(0, len(sequence), line_width):
+        handle.write(sequence[start:start + line_width] + b'\n')
+    return len(header) + 2 + len(sequence) + (len(sequence) + line_width - 1) // line_width
+
+class FastaIndex(object):
+    "Byte offsets of the records in a fasta file (as in a samtools .fai index), for random access to sequences"
+
+    def __init__(self, path, fai_path=None):
+        self.path = path
+        self.names = list()
+        # Keyed by name, holds (length, offset, line_bases, line_width)
+        # line_bases and line_width are 0 for records with irregular line lengths
+        self.records = dict()
+        # Keyed by name, holds the full header line (without the '>'). Headers are not part of a
+        # .fai index, so when one is read they are only collected if header() is called
+        self.headers = None
+        self.handle = None
+        if fai_path and os.path.isfile(fai_path) and os.path.getmtime(fai_path) >= os.path.getmtime(path):
+            self.read_fai(fai_path)
+        else:
+            self.build()
+
+    def build(self):
+        # Offsets are added up from line lengths, as tell() is unreliable while iterating over a file
+        position = 0
+        name = None
+        self.headers = dict()
+        with open(self.path, 'rb') as fasta:
+            for line in fasta:
+                if line.startswith(b'>'):
+                    if name is not None:
+                        self.add_record(name, length, offset, line_lengths)
+                    header = to_str(line[1:].strip())
+                    name = record_name(header)
+                    self.headers[name] = header
+                    length = 0
+                    offset = position + len(line)
+                    line_lengths = list()
+                elif name is not None:
+                    bases = len(line.rstrip(b'\r\n'))
+                    length += bases
+                    line_lengths.append((bases, len(line)))
+                position += len(line)
+        if name is not None:
+            self.add_record(name, length, offset, line_lengths)
+
+    def add_record(self, name, length, offset, line_lengths):
+        if line_lengths:
+            line_bases, line_width = line_lengths[0]
+            # Only the last line of a record may be shorter
+            if any(lengths != (line_bases, line_width) for lengths in line_lengths[:-1]) or line_lengths[-1][0] > line_bases:
+                line_bases, line_width = 0, 0
+        else:
+            line_bases, line_width = 0, 0
+        self.names.append(name)
+        self.records[name] = (length, offset, line_bases, line_width)
+
+    def read_fai(self, fai_path):
+        with open(fai_path) as fai:
+            for line in fai:
+                name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+                self.names.append(name)
+                self.records[name] = (int(length), int(offset), int(line_bases), int(line_width))
+
+    def write_fai(self, fai_path):
+        with open(fai_path, 'w') as fai:
+            for name in self.names:
+                fai.write('\t'.join([name] + [ str(value) for value in self.records[name] ]) + '\n')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getstate__(self):
+        # Open file handles can't be sent to other processes
+        state = self.__dict__.copy()
+        state['handle'] = None
+        return state
+
+    def length(self, name):
+        return self.records[name][0]
+
+    def header(self, name):
+        "Returns the full header line of a record (without the '>'), i.e. the name and description"
+        if self.headers is None:
+            self.headers = dict()
+            with open(self.path, 'rb') as fasta:
+                for line in fasta:
+                    if line.startswith(b'>'):
+                        header = to_str(line[1:].strip())
+                        self.headers[record_name(header)] = header
+        return self.headers[name]
+
+    def fetch(self, name, start=0, end=None):
+        "Returns bases start to end (0-based, end exclusive) of a record as bytes"
+        length, offset, line_bases, line_width = self.records[name]
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return b''
+        if self.handle is None:
+            self.handle = open(self.path, 'rb')
+
+        if line_bases:
+            start_byte = offset + (start // line_bases) * line_width + start % line_bases
+            end_byte = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases + 1
+            self.handle.seek(start_byte)
+            return self.handle.read(end_byte - start_byte).replace(b'\n', b'').replace(b'\r', b'')
+
+        # Irregular line lengths, so we read the record line by line
+        self.handle.seek(offset)
+        sequence_lines = list()
+        for line in self.handle:
+            if line.startswith(b'>'):
+                break
+            sequence_lines.append(line.rstrip(b'\r\n'))
+        return b''.join(sequence_lines)[start:end]
+
+    def sequences(self, names=None):
+        "Returns a list-like view of the sequences of the given records (all by default), read from disk on access"
+        return IndexedSequences(self, self.names if names is None else names)
+
+class IndexedSequences(object):
+    "List-like view of record sequences in a FastaIndex. Only one sequence is held in memory at a time"
+
+    def __init__(self, index, names):
+        self.index = index
+        self.names = list(names)
+        self.lengths = [ index.length(name) for name in self.names ]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return self.index.fetch(self.names[i])
+
+    def subset(self, indices):
+        return IndexedSequences(self.index, [ self.names[i] for i in indices ])
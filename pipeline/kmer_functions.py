@@ -0,0 +1,681 @@
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Functions for counting k-mer frequencies of contigs with numpy arrays
+# Bases are encoded with 2 bits in the order A=0, T=1, C=2, G=3. This is the order used to
+# build the k-mer list in recursive_dbscan.py, so the code of a k-mer is its position in that
+# list, and the complement of a base is simply code ^ 1
+
+import ctypes
+import glob
+import hashlib
+import heapq
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, svds
+from sklearn import decomposition
+
+DNA_LETTERS = ['A', 'T', 'C', 'G']
+
+# From this k-mer size upwards, counts are held as a sparse CSR matrix of raw counts (without the
+# pseudocount of 1, which is added during normalization). Dense matrices keep the pseudocount.
+SPARSE_K_MER_SIZE = 6
+
+# Translates ASCII bytes to 2-bit codes. Anything that is not A, T, C or G (including lower case
+# and N) is flagged as ambiguous with the value 4
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, letter in enumerate(DNA_LETTERS):
+    BASE_CODES[ord(letter)] = code
+
+def reverse_complement_codes(codes, k_mer_size):
+    "Returns the 2-bit codes of the reverse complements of an array of k-mer codes"
+    remaining = np.array(codes, dtype=np.int64)
+    reverse_codes = np.zeros_like(remaining)
+    for i in range(k_mer_size):
+        reverse_codes = (reverse_codes << 2) | ((remaining & 3) ^ 1)
+        remaining >>= 2
+    return reverse_codes
+
+def kmer_lookup(k_mer_size):
+    "Returns an array mapping every k-mer code to its column in the unique (canonical) k-mer list"
+    # A k-mer gets a column if it comes before its reverse complement in the k-mer list, and the
+    # columns are numbered in list order. This reproduces the unique_k_mers dictionary.
+    codes = np.arange(4 ** k_mer_size, dtype=np.int64)
+    canonical_codes = np.minimum(codes, reverse_complement_codes(codes, k_mer_size))
+    column_numbers = np.cumsum(codes == canonical_codes) - 1
+    return column_numbers[canonical_codes]
+
+def canonical_kmers(k_mer_size):
+    "Returns the unique (canonical) k-mers in column order, i.e. the keys of unique_k_mers sorted by index"
+    codes = np.arange(4 ** k_mer_size, dtype=np.int64)
+    canonical_codes = codes[codes <= reverse_complement_codes(codes, k_mer_size)]
+    letters = np.array(DNA_LETTERS)
+    k_mer_letters = [ letters[(canonical_codes >> (2 * (k_mer_size - i - 1))) & 3] for i in range(k_mer_size) ]
+    return [ ''.join(k_mer) for k_mer in zip(*k_mer_letters) ]
+
+def encode_sequence(sequence):
+    "Returns the 2-bit codes of a sequence given as str or bytes"
+    if not isinstance(sequence, bytes):
+        sequence = sequence.encode('ascii')
+    return BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+
+def count_kmers(sequence, lookup, k_mer_size):
+    "Returns the canonical k-mer counts of a sequence as a uint32 array"
+    num_columns = int(lookup.max()) + 1
+    base_codes = encode_sequence(sequence)
+    # Note - the last k-mer of the sequence is not counted, as in the original per-base loop,
+    # so that k-mer matrices stay identical to those made by earlier versions
+    num_windows = len(base_codes) - k_mer_size
+    if num_windows <= 0:
+        return np.zeros(num_columns, dtype=np.uint32)
+
+    # Rolling k-mer codes, built one base position at a time over the whole sequence
+    k_mer_codes = np.zeros(num_windows, dtype=np.int64)
+    for i in range(k_mer_size):
+        k_mer_codes <<= 2
+        k_mer_codes |= base_codes[i:i + num_windows] & 3
+
+    # Skip any k-mer containing an ambiguous base
+    ambiguous_total = np.concatenate(([0], np.cumsum(base_codes > 3)))
+    valid = ambiguous_total[k_mer_size:k_mer_size + num_windows] == ambiguous_total[:num_windows]
+
+    counts = np.bincount(lookup[k_mer_codes[valid]], minlength=num_columns)
+    return counts.astype(np.uint32)
+
+def count_rows(count_matrix, rows, start, end):
+    "Returns rows start to end of a count matrix, or of its rows listed in rows (if not None)"
+    # Only these rows are copied into memory, the rest of a memory-mapped matrix stays on disk
+    if rows is None:
+        return count_matrix[start:end]
+    return count_matrix[rows[start:end]]
+
+def observed_kmer_columns(count_matrix, chunk_rows=10000, rows=None):
+    "Returns the indices of the k-mer columns observed in at least one row (of those listed in rows, if given), read in chunks of rows"
+    if sparse.issparse(count_matrix):
+        count_matrix = sparse.csr_matrix(count_matrix)
+        if rows is not None:
+            count_matrix = count_matrix[rows]
+        return np.flatnonzero(count_matrix.getnnz(axis=0)).astype(np.int32)
+    # Dense matrices include the pseudocount, so unobserved k-mers have a count of 1
+    num_rows = count_matrix.shape[0] if rows is None else len(rows)
+    observed = np.zeros(count_matrix.shape[1], dtype=bool)
+    for start in range(0, num_rows, chunk_rows):
+        observed |= (np.asarray(count_rows(count_matrix, rows, start, start + chunk_rows)) > 1).any(axis=0)
+    return np.flatnonzero(observed).astype(np.int32)
+
+def normalize_kmers(count_matrix, columns=None):
+    "Returns the centered log-ratio (CLR) transform of a k-mer count matrix as a float32 matrix (or SparseCLR)"
+    # See Aitchison, J. The Statistical Analysis of Compositional Data (1986) and
+    # Pawlowsky-Glahn, Egozcue, Tolosana-Delgado. Lecture Notes on Compositional Data Analysis (2011)
+    # columns are the k-mers to keep, by default those observed in the matrix (as returned by observed_kmer_columns)
+    if sparse.issparse(count_matrix):
+        return SparseCLR(count_matrix, columns)
+    count_matrix = np.asarray(count_matrix)
+
+    # We remove all the k-mers where all counts are 1 (i.e. only the pseudocount)
+    if columns is None:
+        columns = np.flatnonzero((count_matrix > 1).any(axis=0))
+    if count_matrix.dtype == np.float32 and len(columns) == count_matrix.shape[1]:
+        # A float32 matrix with nothing to trim is transformed in place
+        normalized = count_matrix
+    else:
+        normalized = count_matrix[:, columns].astype(np.float32)
+
+    # CLR does not depend on the scale of each row, so the division of counts by row totals to
+    # get frequencies cancels out, and log(x / geometric mean) is log(x) - mean(log(x))
+    np.log(normalized, out=normalized)
+    normalized -= normalized.mean(axis=1, keepdims=True, dtype=np.float64).astype(np.float32)
+    return normalized
+
+class SparseCLR(object):
+    "CLR transform of a sparse matrix of raw k-mer counts, held as log(count + 1) and the mean of each row"
+
+    def __init__(self, count_matrix, columns=None):
+        count_matrix = sparse.csr_matrix(count_matrix)
+        count_matrix.eliminate_zeros()
+        # We remove all the k-mers that were never observed
+        if columns is None:
+            columns = np.flatnonzero(count_matrix.getnnz(axis=0))
+        self.log_counts = count_matrix[:, columns].astype(np.float32)
+        # The pseudocount of 1 leaves unobserved k-mers at log(1) = 0, so the matrix stays sparse
+        np.log1p(self.log_counts.data, out=self.log_counts.data)
+        self.shape = self.log_counts.shape
+        row_totals = np.asarray(self.log_counts.sum(axis=1, dtype=np.float64)).ravel()
+        self.row_means = row_totals / max(self.shape[1], 1)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def toarray(self):
+        "Returns the dense float32 CLR matrix"
+        dense = self.log_counts.toarray()
+        dense -= self.row_means[:, np.newaxis].astype(np.float32)
+        return dense
+
+    def column_means(self):
+        "Returns the mean of each column of the CLR matrix"
+        return np.asarray(self.log_counts.mean(axis=0, dtype=np.float64)).ravel() - self.row_means.mean()
+
+    def project(self, mean, components):
+        "Returns (CLR - mean) . components^T, without densifying"
+        components = np.asarray(components, dtype=np.float64)
+        return self.log_counts.dot(components.T) - np.outer(self.row_means, components.sum(axis=1)) - np.dot(mean, components.T)[np.newaxis, :]
+
+    def centered_operator(self):
+        "Returns the column-centered CLR matrix (as PCA uses it) as a LinearOperator, without densifying"
+        log_counts = self.log_counts
+        row_means = self.row_means
+        column_means = self.column_means()
+
+        def matmat(V):
+            V = np.asarray(V, dtype=np.float64).reshape(self.shape[1], -1)
+            return log_counts.dot(V) - np.outer(row_means, V.sum(axis=0)) - column_means.dot(V)[np.newaxis, :]
+
+        def rmatmat(U):
+            U = np.asarray(U, dtype=np.float64).reshape(self.shape[0], -1)
+            return log_counts.T.dot(U) - np.outer(np.ones(self.shape[1]), row_means.dot(U)) - np.outer(column_means, U.sum(axis=0))
+
+        return LinearOperator(self.shape, dtype=np.float64, matvec=matmat, rmatvec=rmatmat, matmat=matmat)
+
+PCA_MODES = ['auto', 'full', 'randomized', 'incremental']
+
+# In auto mode, dense normalized matrices up to PCA_FULL_SVD_LIMIT values get a full SVD, larger
+# ones up to PCA_IN_MEMORY_LIMIT bytes get a randomized SVD, and anything larger is fitted with
+# IncrementalPCA over chunks of PCA_CHUNK_ROWS rows, normalized one chunk at a time
+PCA_FULL_SVD_LIMIT = 10000000
+PCA_IN_MEMORY_LIMIT = 1 << 30
+PCA_CHUNK_ROWS = 10000
+
+def choose_pca_mode(num_rows, num_columns):
+    "Returns the PCA mode used in auto mode for a dense normalized matrix of the given shape"
+    if num_rows * num_columns * 4 > PCA_IN_MEMORY_LIMIT:
+        return 'incremental'
+    if num_rows * num_columns > PCA_FULL_SVD_LIMIT:
+        return 'randomized'
+    return 'full'
+
+def row_chunks(num_rows, chunk_rows, min_rows=1):
+    "Returns (start, end) of consecutive chunks of rows, none of them shorter than min_rows (unless there is only one)"
+    num_chunks = max(1, min(-(-num_rows // chunk_rows), num_rows // max(min_rows, 1)))
+    bounds = np.linspace(0, num_rows, num_chunks + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def fit_pca(count_matrix, n_components, mode='auto', rows=None):
+    "Returns the projection of the normalized counts onto their first n_components principal components (float32), and the PCA model"
+    # The model holds the k-mer columns kept by normalization, the mean and the components, so that
+    # other contigs (or the same contigs in another script) can be projected with apply_pca. It also
+    # names the solver that was used, as mode only applies to dense counts
+    # rows are the rows of count_matrix to fit (all by default). Dense counts are read in chunks of rows,
+    # so a memory-mapped count matrix is never copied into memory as a whole
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+    if sparse.issparse(count_matrix):
+        # Sparse counts are compact, so the rows are simply copied
+        if rows is not None:
+            count_matrix = sparse.csr_matrix(count_matrix)[rows]
+        normalized = SparseCLR(count_matrix)
+        columns = observed_kmer_columns(count_matrix)
+        if min(normalized.shape) < 2:
+            # svds needs 0 < k < min(shape), which a matrix this small can't give. It is tiny, so it
+            # is densified and gets a full SVD instead
+            solver = 'full'
+            pca = decomposition.PCA(n_components=min(n_components, min(normalized.shape)))
+            projection = pca.fit_transform(normalized.toarray())
+            mean = pca.mean_
+            components = pca.components_
+        else:
+            # Truncated SVD of the implicitly centered matrix gives the same projection as PCA
+            solver = 'sparse svds'
+            n_components = min(n_components, min(normalized.shape) - 1)
+            start_vector = np.random.RandomState(0).uniform(-1, 1, min(normalized.shape))
+            U, S, Vt = svds(normalized.centered_operator(), k=n_components, v0=start_vector)
+            order = np.argsort(S)[::-1]
+            U, S, Vt = U[:, order], S[order], Vt[order]
+            # Same sign convention as sklearn (largest loading of each component is positive)
+            signs = np.sign(Vt[np.arange(len(S)), np.argmax(np.abs(Vt), axis=1)])
+            signs[signs == 0] = 1
+            projection = U * S * signs
+            mean = normalized.column_means()
+            components = Vt * signs[:, np.newaxis]
+    else:
+        num_rows = count_matrix.shape[0] if rows is None else len(rows)
+        columns = observed_kmer_columns(count_matrix, PCA_CHUNK_ROWS, rows)
+        if mode == 'auto':
+            mode = choose_pca_mode(num_rows, len(columns))
+        solver = mode
+
+        if mode == 'incremental':
+            # Only one chunk of the normalized matrix is in memory at a time. Each chunk needs at least
+            # n_components rows
+            chunks = row_chunks(num_rows, PCA_CHUNK_ROWS, n_components)
+            pca = decomposition.IncrementalPCA(n_components=n_components)
+            for start, end in chunks:
+                pca.partial_fit(normalize_kmers(count_rows(count_matrix, rows, start, end), columns))
+            projection = np.vstack([ pca.transform(normalize_kmers(count_rows(count_matrix, rows, start, end), columns)) for start, end in chunks ])
+        else:
+            # CLR normalizes each row on its own, so the normalized matrix is built one chunk of counts at a time
+            normalized = np.vstack([ normalize_kmers(count_rows(count_matrix, rows, start, end), columns)
+                for start, end in row_chunks(num_rows, PCA_CHUNK_ROWS) ])
+            if mode == 'randomized':
+                # The approximate U * S of a randomized SVD is not quite the projection that apply_pca
+                # would give, so the contigs are projected onto the fitted components instead
+                pca = decomposition.PCA(n_components=n_components, svd_solver='randomized', random_state=0)
+                projection = pca.fit(normalized).transform(normalized)
+            else:
+                pca = decomposition.PCA(n_components=n_components)
+                projection = pca.fit_transform(normalized)
+        mean = pca.mean_
+        components = pca.components_
+
+    model = { 'columns': columns, 'mean': np.asarray(mean, dtype=np.float32), 'components': np.asarray(components, dtype=np.float32), 'solver': solver }
+    return np.asarray(projection, dtype=np.float32), model
+
+def apply_pca(count_matrix, model, chunk_rows=PCA_CHUNK_ROWS, rows=None):
+    "Returns the projection of k-mer counts (the rows listed in rows, if given) with a PCA model from fit_pca, as float32"
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+    num_rows = count_matrix.shape[0] if rows is None else len(rows)
+    projections = list()
+    for start, end in row_chunks(num_rows, chunk_rows):
+        normalized = normalize_kmers(count_rows(count_matrix, rows, start, end), model['columns'])
+        if isinstance(normalized, SparseCLR):
+            projections.append(normalized.project(model['mean'], model['components']))
+        else:
+            projections.append(np.dot(normalized - model['mean'], model['components'].T))
+    if not projections:
+        return np.zeros((0, len(model['components'])), dtype=np.float32)
+    return np.vstack(projections).astype(np.float32)
+
+def write_pca_model(path, model, k_mers):
+    "Writes a PCA model from fit_pca, with the k-mers of its columns so the model can be checked against a k-mer matrix"
+    with open(path, 'wb') as model_file:
+        np.savez(model_file, columns=model['columns'], mean=model['mean'], components=model['components'],
+            k_mers=np.array([ k_mers[column] for column in model['columns'] ]))
+
+def read_pca_model(path, k_mers):
+    "Returns a PCA model written by write_pca_model, or None if its k-mers don't match the k-mers (columns) of a matrix"
+    arrays = np.load(path)
+    model = { 'columns': arrays['columns'], 'mean': arrays['mean'], 'components': arrays['components'] }
+    if len(model['columns']) and model['columns'].max() >= len(k_mers):
+        return None
+    if [ str(k_mer) for k_mer in arrays['k_mers'] ] != [ k_mers[column] for column in model['columns'] ]:
+        return None
+    return model
+
+def split_shards(lengths, num_shards):
+    "Returns lists of indices into lengths, split so that each shard has a similar total length"
+    # Longest sequences first, each one going to the shard with the smallest total so far
+    shards = [list() for i in range(num_shards)]
+    shard_heap = [(0, i) for i in range(num_shards)]
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        total, shard_number = heapq.heappop(shard_heap)
+        shards[shard_number].append(index)
+        heapq.heappush(shard_heap, (total + lengths[index], shard_number))
+    return [sorted(shard) for shard in shards if shard]
+
+# Holds the shared count matrix, the sequences and the lookup array within each counting worker
+worker_data = dict()
+
+def init_counting_worker(shared_counts, shape, sequences, k_mer_size):
+    if shared_counts is not None:
+        worker_data['counts'] = np.frombuffer(shared_counts, dtype=np.uint32).reshape(shape)
+    worker_data['sequences'] = sequences
+    worker_data['lookup'] = kmer_lookup(k_mer_size)
+    worker_data['k_mer_size'] = k_mer_size
+
+def count_shard(shard):
+    "Counts k-mers of the sequences in a shard (list of rows) into the shared matrix. Returns (pid, bp, seconds) for the shard"
+    start_time = time.time()
+    shard_bp = 0
+    for row in shard:
+        sequence = worker_data['sequences'][row]
+        worker_data['counts'][row] = count_kmers(sequence, worker_data['lookup'], worker_data['k_mer_size'])
+        shard_bp += len(sequence)
+    return os.getpid(), shard_bp, time.time() - start_time
+
+def count_shard_sparse(shard):
+    "Counts k-mers of the sequences in a shard (list of rows). Returns the rows, their CSR counts and (pid, bp, seconds) for the shard"
+    start_time = time.time()
+    shard_bp = 0
+    data = list()
+    indices = list()
+    indptr = [0]
+    for row in shard:
+        sequence = worker_data['sequences'][row]
+        counts = count_kmers(sequence, worker_data['lookup'], worker_data['k_mer_size'])
+        columns = np.flatnonzero(counts)
+        data.append(counts[columns])
+        indices.append(columns.astype(np.int32))
+        indptr.append(indptr[-1] + len(columns))
+        shard_bp += len(sequence)
+    num_columns = int(worker_data['lookup'].max()) + 1
+    shard_counts = sparse.csr_matrix((np.concatenate(data), np.concatenate(indices), np.array(indptr)), shape=(len(shard), num_columns))
+    return shard, shard_counts, (os.getpid(), shard_bp, time.time() - start_time)
+
+def make_counting_pool(processors, worker_arguments):
+    "Returns a pool of forked counting workers, or None if processes can't be forked"
+    # Under spawn or forkserver each worker would import __main__, and so run the calling script again
+    if hasattr(multiprocessing, 'get_all_start_methods'):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return None
+        return multiprocessing.get_context('fork').Pool(processors, init_counting_worker, worker_arguments)
+    if sys.platform.startswith('win'):
+        return None
+    return multiprocessing.Pool(processors, init_counting_worker, worker_arguments)
+
+def count_kmers_parallel(sequences, k_mer_size, processors=1, use_sparse=False):
+    "Returns a uint32 k-mer count matrix with one row per sequence (CSR if use_sparse), and (pid, bp, seconds) for each worker"
+    # sequences may be a list, or a list-like object with a lengths attribute that reads sequences on
+    # demand (see fasta_functions.IndexedSequences), in which case workers read their own sequences
+    num_columns = int(kmer_lookup(k_mer_size).max()) + 1
+    shape = (len(sequences), num_columns)
+    lengths = getattr(sequences, 'lengths', None)
+    if lengths is None:
+        lengths = [len(sequence) for sequence in sequences]
+    shards = split_shards(lengths, processors)
+
+    if use_sparse:
+        # Each shard comes back as one CSR matrix, there is no dense matrix to share
+        shared_counts = None
+        count_function = count_shard_sparse
+    else:
+        # Workers write their rows straight into shared memory, so only the throughput stats are sent back
+        shared_counts = multiprocessing.RawArray(ctypes.c_uint32, shape[0] * shape[1])
+        count_function = count_shard
+
+    pool = None
+    if processors > 1 and len(shards) > 1:
+        pool = make_counting_pool(processors, (shared_counts, shape, sequences, k_mer_size))
+    if pool is not None:
+        shard_output = pool.map(count_function, shards, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        init_counting_worker(shared_counts, shape, sequences, k_mer_size)
+        shard_output = [count_function(shard) for shard in shards]
+
+    if not use_sparse:
+        counts = np.frombuffer(shared_counts, dtype=np.uint32).reshape(shape)
+        return counts, shard_output
+
+    if not shard_output:
+        return sparse.csr_matrix(shape, dtype=np.uint32), list()
+    shard_rows = np.concatenate([ rows for rows, shard_counts, stats in shard_output ])
+    counts = sparse.vstack([ shard_counts for rows, shard_counts, stats in shard_output ], format='csr')
+    # Put the rows back in the order of the input sequences
+    counts = counts[np.argsort(shard_rows)]
+    return counts, [ stats for rows, shard_counts, stats in shard_output ]
+
+def compact_count_dtype(counts):
+    "Returns uint16 if all counts fit with room for a pseudocount, otherwise uint32"
+    max_count = counts.max() if counts.size else 0
+    return np.uint16 if max_count < np.iinfo(np.uint16).max else np.uint32
+
+def is_binary_matrix(path):
+    "Returns True if path holds a binary k-mer matrix (an .npz archive) rather than a TSV table"
+    with open(path, 'rb') as matrix:
+        return matrix.read(4) == b'PK\x03\x04'
+
+def write_kmer_matrix(path, contigs, k_mers, counts, tsv=False):
+    "Writes k-mer counts, binary by default. The tsv format is the one made by earlier versions of recursive_dbscan.py"
+    if tsv:
+        with open(path, 'w') as matrix:
+            # The first line consists of the k-mer headings (left corner is blank because the contig names are listed under it)
+            matrix.write('\t'.join([''] + list(k_mers)) + '\n')
+            for i, contig in enumerate(contigs):
+                if sparse.issparse(counts):
+                    # Sparse matrices hold raw counts, the tsv format includes the pseudocount
+                    row = counts[i].toarray().ravel() + 1
+                else:
+                    row = counts[i]
+                matrix.write('\t'.join([contig] + [ str(count) for count in row ]) + '\n')
+    elif sparse.issparse(counts):
+        counts = sparse.csr_matrix(counts)
+        counts = counts.astype(compact_count_dtype(counts.data))
+        with open(path, 'wb') as matrix:
+            np.savez(matrix, data=counts.data, indices=counts.indices, indptr=counts.indptr, shape=np.array(counts.shape),
+                contigs=np.array(contigs), k_mers=np.array(k_mers))
+    else:
+        # Arrays are stored uncompressed, so the counts can be memory-mapped by read_kmer_matrix
+        # Counts are stored as uint16 when they fit, which halves the size of the matrix for most assemblies
+        counts = np.asarray(counts)
+        with open(path, 'wb') as matrix:
+            np.savez(matrix, counts=counts.astype(compact_count_dtype(counts), copy=False), contigs=np.array(contigs), k_mers=np.array(k_mers))
+
+def memmap_npz_array(path, name):
+    "Memory-maps an array stored uncompressed in an .npz archive"
+    with zipfile.ZipFile(path) as archive:
+        member = archive.getinfo(name + '.npy')
+    if member.compress_type != zipfile.ZIP_STORED:
+        return np.load(path)[name]
+
+    with open(path, 'rb') as archive:
+        # The array data follows the zip local file header and the .npy header
+        archive.seek(member.header_offset)
+        local_header = archive.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        archive.seek(member.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(archive)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(archive)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(archive)
+        offset = archive.tell()
+
+    if not shape or 0 in shape:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+def read_kmer_matrix(path):
+    "Returns (contigs, k_mers, counts) from a binary or tsv k-mer matrix. Binary counts are memory-mapped (uint16 or uint32), and may be CSR"
+    if is_binary_matrix(path):
+        arrays = np.load(path)
+        contigs = [ str(contig) for contig in arrays['contigs'] ]
+        k_mers = [ str(k_mer) for k_mer in arrays['k_mers'] ]
+        if 'indptr' in arrays.files:
+            # Sparse matrix of raw counts
+            arrays_for_csr = [ memmap_npz_array(path, name) for name in ('data', 'indices', 'indptr') ]
+            counts = sparse.csr_matrix(tuple(arrays_for_csr), shape=tuple(arrays['shape']))
+        else:
+            counts = memmap_npz_array(path, 'counts')
+        return contigs, k_mers, counts
+
+    contigs = list()
+    rows = list()
+    with open(path) as matrix:
+        k_mers = matrix.readline().rstrip('\n').split('\t')[1:]
+        for line in matrix:
+            line_list = line.rstrip().split('\t')
+            contigs.append(line_list.pop(0))
+            rows.append(np.array(line_list, dtype=np.uint32))
+    counts = np.vstack(rows) if rows else np.zeros((0, len(k_mers)), dtype=np.uint32)
+    return contigs, k_mers, counts
+
+def sequence_hash(sequence):
+    "Returns the hex SHA-1 digest of a sequence, used to key cached k-mer counts"
+    if not isinstance(sequence, bytes):
+        sequence = sequence.encode('ascii')
+    return hashlib.sha1(sequence).hexdigest()
+
+# The cache for each k-mer size is a set of shards named <k>-mer_counts.<unique id>.npz. Each run that
+# counts new sequences adds a shard, and once there are KMER_CACHE_MERGE_SHARDS shards of fewer than
+# KMER_CACHE_SMALL_SHARD_ROWS rows they are merged into one, so the number of shards stays bounded without
+# ever rewriting the large ones. Cached counts never go stale (they are keyed by sequence), so the only
+# clean up needed is to delete the cache directory when the space is wanted back
+KMER_CACHE_SMALL_SHARD_ROWS = 10000
+KMER_CACHE_MERGE_SHARDS = 8
+
+def kmer_cache_prefix(k_mer_size):
+    return '{}-mer_counts.'.format(k_mer_size)
+
+def kmer_cache_shards(cache_dir, k_mer_size):
+    "Returns the paths of the k-mer matrices (shards) that make up the cache for a k-mer size"
+    return sorted(glob.glob(os.path.join(cache_dir, kmer_cache_prefix(k_mer_size) + '*.npz')))
+
+def write_kmer_cache_shard(cache_dir, k_mer_size, hashes, counts):
+    "Writes new cache rows as a shard of their own, so that runs sharing a cache never rewrite each other's rows"
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Another run may have made it in the meantime
+            if not os.path.isdir(cache_dir):
+                raise
+    # The shard is written under a unique temporary name and then renamed, so that an interrupted
+    # run can't leave a corrupt shard and concurrent runs can't write to the same file
+    temporary_handle, temporary_path = tempfile.mkstemp(dir=cache_dir, prefix=kmer_cache_prefix(k_mer_size), suffix='.tmp')
+    os.close(temporary_handle)
+    try:
+        write_kmer_matrix(temporary_path, hashes, canonical_kmers(k_mer_size), counts)
+        shard_path = temporary_path[:-len('.tmp')] + '.npz'
+        os.rename(temporary_path, shard_path)
+    except BaseException:
+        if os.path.isfile(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return shard_path
+
+class SequenceHashError(ValueError):
+    "Raised when a sequence hash given to KmerCache.add doesn't match its sequence"
+    pass
+
+class KmerCache(object):
+    "Raw k-mer counts cached by sequence hash in a directory, which can be shared between runs"
+    # The cache is a set of k-mer matrices (shards) whose rows are keyed by sequence hash instead of
+    # contig name. Only the hashes are read up front, counts are memory-mapped and read when asked for
+
+    def __init__(self, cache_dir, k_mer_size, use_sparse=False):
+        self.cache_dir = cache_dir
+        self.k_mer_size = k_mer_size
+        self.use_sparse = use_sparse
+        # Keyed by hash, holds (shard number, row)
+        self.index = dict()
+        # The paths, hashes and counts of each shard
+        self.shard_paths = list()
+        self.shard_hashes = list()
+        self.shards = list()
+        # Numbers of the shards that have been merged into another, whose files are gone
+        self.merged_shards = set()
+        for shard_path in kmer_cache_shards(cache_dir, k_mer_size):
+            try:
+                self.add_shard(shard_path)
+            except (IOError, OSError, ValueError, zipfile.BadZipfile):
+                # Unreadable shards are ignored, their sequences are counted again
+                continue
+
+    def __contains__(self, sequence_hash):
+        return sequence_hash in self.index
+
+    def add_shard(self, shard_path):
+        shard_hashes, shard_k_mers, shard_counts = read_kmer_matrix(shard_path)
+        for row, cached_hash in enumerate(shard_hashes):
+            if cached_hash not in self.index:
+                self.index[cached_hash] = (len(self.shards), row)
+        self.shard_paths.append(shard_path)
+        self.shard_hashes.append(shard_hashes)
+        self.shards.append(shard_counts)
+
+    def merge_small_shards(self):
+        "Merges the small shards into one once there are KMER_CACHE_MERGE_SHARDS of them"
+        small_shards = [ number for number, shard_counts in enumerate(self.shards)
+            if shard_counts.shape[0] < KMER_CACHE_SMALL_SHARD_ROWS and number not in self.merged_shards ]
+        if len(small_shards) < KMER_CACHE_MERGE_SHARDS:
+            return
+        merged_hashes = list()
+        for number in small_shards:
+            merged_hashes.extend(self.shard_hashes[number])
+        if self.use_sparse:
+            merged_counts = sparse.vstack([ sparse.csr_matrix(self.shards[number]) for number in small_shards ], format='csr')
+        else:
+            merged_counts = np.vstack([ np.asarray(self.shards[number], dtype=np.uint32) for number in small_shards ])
+        # The merged shard is in place before the small ones are removed. A run reading the cache at the
+        # same time ignores a shard that has gone, so at worst it counts those sequences again. This
+        # cache keeps reading rows from the small shards it has already memory-mapped
+        merged_path = write_kmer_cache_shard(self.cache_dir, self.k_mer_size, merged_hashes, merged_counts)
+        self.add_shard(merged_path)
+        for number in small_shards:
+            self.merged_shards.add(number)
+            try:
+                os.remove(self.shard_paths[number])
+            except OSError:
+                # Already merged away by another run
+                pass
+
+    def add(self, hashes, sequences, processors=1):
+        "Counts the k-mers of sequences (one per hash) and writes them to the cache as a new shard. Returns the worker stats"
+        # Hashes may come from a table rather than the sequences themselves, so they are checked first.
+        # Counts stored under the wrong hash would be wrong for every run sharing the cache
+        for given_hash, sequence in zip(hashes, sequences):
+            if sequence_hash(sequence) != given_hash:
+                raise SequenceHashError('sequence hash {} does not match its sequence'.format(given_hash))
+        new_counts, worker_stats = count_kmers_parallel(sequences, self.k_mer_size, processors, self.use_sparse)
+        shard_path = write_kmer_cache_shard(self.cache_dir, self.k_mer_size, hashes, new_counts)
+        # The new shard is read back memory-mapped, so the counts of a run don't pile up in memory
+        self.add_shard(shard_path)
+        self.merge_small_shards()
+        return worker_stats
+
+    def counts(self, hashes):
+        "Returns the cached counts of the given hashes, uint32 (CSR if use_sparse)"
+        if not len(hashes):
+            return count_kmers_parallel(list(), self.k_mer_size, 1, self.use_sparse)[0]
+        # Rows are gathered shard by shard, so only the rows asked for are read from each shard
+        locations = np.array([ self.index[sequence_hash] for sequence_hash in hashes ], dtype=np.int64)
+        blocks = list()
+        block_rows = list()
+        for shard_number, shard_counts in enumerate(self.shards):
+            rows = np.flatnonzero(locations[:, 0] == shard_number)
+            if not len(rows):
+                continue
+            if self.use_sparse:
+                blocks.append(sparse.csr_matrix(shard_counts)[locations[rows, 1]].astype(np.uint32))
+            else:
+                blocks.append(np.asarray(shard_counts[locations[rows, 1]], dtype=np.uint32))
+            block_rows.append(rows)
+        order = np.argsort(np.concatenate(block_rows), kind='stable')
+        if self.use_sparse:
+            return sparse.vstack(blocks, format='csr')[order]
+        return np.vstack(blocks)[order]
+
+def cached_kmer_counts(cache_dir, hashes, sequences, k_mer_size, processors=1, use_sparse=False):
+    "Returns raw k-mer counts for each hash, counting only sequences missing from the cache, plus worker stats and the number counted"
+    cache = KmerCache(cache_dir, k_mer_size, use_sparse)
+
+    # Identical sequences are only counted once
+    missing = list()
+    missing_hashes = set()
+    for i, sequence_hash in enumerate(hashes):
+        if sequence_hash not in cache and sequence_hash not in missing_hashes:
+            missing_hashes.add(sequence_hash)
+            missing.append(i)
+
+    worker_stats = list()
+    if missing:
+        if hasattr(sequences, 'subset'):
+            missing_sequences = sequences.subset(missing)
+        else:
+            missing_sequences = [sequences[i] for i in missing]
+        worker_stats = cache.add([hashes[i] for i in missing], missing_sequences, processors)
+
+    return cache.counts(hashes), worker_stats, len(missing)
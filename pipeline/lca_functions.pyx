@@ -54,7 +54,8 @@ def Preprocess(level_array):
     "Returns a sparse table with the level array associated with its respective eulerian tour from tree construction"
     n = int(len(level_array))
     num_columns = int(np.floor(np.log2(n))+1)
-    sparse_table = np.empty((n,num_columns))
+    sparse_table = np.empty((n,num_columns), dtype=np.int32)
+    #sparse table holds indices of the level array, so int32 is enough (and half the size of float64)
     #height of sparse table is from 0 to n
     #width of sparse table is from 0 to logn
     sparse_table[:,0] = [index for index,values in enumerate(level_array)]
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Ian J. Miller, Evan Rees, Izaak Miller, Jason C. Kwan
+#
+# This file is part of Autometa.
+#
+# Autometa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Autometa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Autometa. If not, see <http://www.gnu.org/licenses/>.
+
+# Program to make the length filtered assembly, the contig table (length, gc, N content, coverage and
+# sequence hash) and the k-mer counts of an assembly, reading the assembly only once
+# This replaces separate runs of fasta_length_trim.pl and make_contig_table.py. K-mer counts go to the
+# k-mer cache, keyed by the sha1 column of the table, so recursive_dbscan.py finds all its counts in
+# the cache without reading the assembly again
+# If you do not specify a coverage table, it attempts to use the contig name
+
+import argparse
+import os
+import time
+import multiprocessing
+import fasta_functions
+import kmer_functions
+
+GC_BASES = [b'G', b'C', b'S', b'g', b'c', b's']
+N_BASES = [b'N', b'n']
+
+# Contigs missing from the k-mer cache are held in memory until they add up to this many bp, then
+# counted (on all processors) and written to the cache as one shard
+K_MER_BATCH_BP = 100000000
+
+def base_percent(sequence, bases):
+	# Same as Bio.SeqUtils.GC, ambiguous bases count towards the length
+	if not sequence:
+		return 0.0
+	return sum(sequence.count(base) for base in bases) * 100.0 / len(sequence)
+
+def print_worker_stats(worker_stats):
+	# Throughput of each k-mer counting worker, as logged by recursive_dbscan.py
+	for worker_pid, worker_bp, worker_seconds in worker_stats:
+		print('Worker {}: counted {} bp in {:.1f} s ({:.0f} bp/s)'.format(worker_pid, worker_bp, worker_seconds, worker_bp / max(worker_seconds, 1e-6)))
+
+#argument parser
+parser = argparse.ArgumentParser(description="Script to make a length filtered assembly, a gc, length, N content and coverage table, and k-mer counts from an assembly in one pass",\
+  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-a', '--assembly', metavar='<assembly.fasta>', help='Path to assembly fasta', required=True)
+parser.add_argument('-l', '--length_cutoff', metavar='<int>', help='Contig length cutoff in bp, shorter contigs are left out of all outputs', type=int, default=0)
+parser.add_argument('-f', '--filtered_assembly', metavar='<assembly.filtered.fasta>', help='Path to write contigs that pass the length cutoff (a .fai index is written alongside)')
+parser.add_argument('-c', '--coverage', metavar='<coverage.tab>', help='Path to coverage table made by calculate_read_coverage.py \
+	 [if not supplied coverage will be inferred from contig names]')
+parser.add_argument('-o', '--output', metavar='<output.tab>', help='Path to create output table', required=True)
+parser.add_argument('-n', '--no_coverage', help='Specifies not to try to add coverage to the table', action='store_true')
+parser.add_argument('--k_mer_cache', metavar='<dir>', help='Directory of the k-mer count cache used by recursive_dbscan.py. If not specified k-mers are not counted')
+parser.add_argument('--k_mer_size', metavar='<int>', help='Length of k-mers to count (3-8)', type=int, choices=range(3, 9), default=5)
+parser.add_argument('-p', '--processors', metavar='<int>', help='Number of processors to use for k-mer counting', type=int, default=1)
+
+args = vars(parser.parse_args())
+
+fasta_assembly_path = os.path.abspath(args['assembly'])
+length_cutoff = args['length_cutoff']
+filtered_assembly_path = args['filtered_assembly']
+coverage_table_path = args['coverage']
+output_table_path = args['output']
+no_coverage_mode = args['no_coverage']
+k_mer_cache_dir = args['k_mer_cache']
+k_mer_size = args['k_mer_size']
+processors = min(args['processors'], multiprocessing.cpu_count())
+
+use_coverage_table = False
+
+if coverage_table_path is not None:
+	use_coverage_table = True
+	# We need to parse the coverage table now
+	coverages = dict() # Will be keyed by contig name
+	if os.path.isfile(coverage_table_path):
+		with open(coverage_table_path) as table:
+			for i,line in enumerate(table):
+				if i > 0:
+					line_list = line.rstrip().split('\t')
+					contig = line_list[0]
+					coverage = float(line_list[1])
+					coverages[contig] = coverage
+	else:
+		print('Error, couldnt find file ' + coverage_table_path + ' or it is unreadable')
+		quit()
+
+output = open(output_table_path, 'w')
+
+if no_coverage_mode:
+	output.write('contig\tlength\tgc\tn_content\tsha1\n')
+else:
+	output.write('contig\tlength\tgc\tn_content\tcov\tsha1\n')
+
+if filtered_assembly_path:
+	filtered_assembly = open(filtered_assembly_path, 'wb')
+	filtered_fai = list()
+	filtered_position = 0
+
+if k_mer_cache_dir:
+	k_mer_cache = kmer_functions.KmerCache(k_mer_cache_dir, k_mer_size, k_mer_size >= kmer_functions.SPARSE_K_MER_SIZE)
+	batch_hashes = list()
+	batch_hash_set = set()
+	batch_sequences = list()
+	batch_bp = 0
+	number_counted = 0
+	counting_seconds = 0.0
+
+number_contigs = 0
+
+start_time = time.time()
+for header, sequence in fasta_functions.read_fasta(fasta_assembly_path, full_header=True):
+	length = len(sequence)
+	if length < length_cutoff:
+		continue
+	contig = fasta_functions.record_name(header)
+	number_contigs += 1
+
+	if filtered_assembly_path:
+		# The filtered assembly keeps full header lines, and its index is worked out as it is written
+		record_offset = filtered_position + len(header.encode('utf-8')) + 2
+		filtered_position += fasta_functions.write_fasta(filtered_assembly, header, sequence)
+		line_bases = min(length, 60)
+		line_width = line_bases + 1 if line_bases else 0
+		filtered_fai.append('\t'.join([contig, str(length), str(record_offset), str(line_bases), str(line_width)]))
+
+	contig_hash = kmer_functions.sequence_hash(sequence)
+	if k_mer_cache_dir and contig_hash not in k_mer_cache and contig_hash not in batch_hash_set:
+		batch_hashes.append(contig_hash)
+		batch_hash_set.add(contig_hash)
+		batch_sequences.append(sequence)
+		batch_bp += length
+		if batch_bp >= K_MER_BATCH_BP:
+			counting_start_time = time.time()
+			print_worker_stats(k_mer_cache.add(batch_hashes, batch_sequences, processors))
+			counting_seconds += time.time() - counting_start_time
+			number_counted += len(batch_hashes)
+			batch_hashes = list()
+			batch_hash_set = set()
+			batch_sequences = list()
+			batch_bp = 0
+
+	gc = str(base_percent(sequence, GC_BASES))
+	n_content = str(base_percent(sequence, N_BASES))
+	if use_coverage_table:
+		if contig in coverages:
+			cov = coverages[contig]
+		else:
+			print('Error, ' + contig + ' not found in the coverage table')
+			quit()
+		output.write(contig + '\t' + str(length) + '\t' + gc + '\t' + n_content + '\t' + str(cov) + '\t' + contig_hash + '\n')
+	elif no_coverage_mode:
+		output.write(contig + '\t' + str(length) + '\t' + gc + '\t' + n_content + '\t' + contig_hash + '\n')
+	else:
+		# Do a format check to make sure the contig name is right
+		contigList = contig.split('_')
+		if len(contigList) > 5 and contigList[0] == 'NODE' and contigList[2] == 'length' and contigList[4] == 'cov':
+			cov = str(contigList[5])
+		else:
+			print('Error, ' + contig + ' not the right format to extract coverage from sequence name')
+			quit()
+		output.write(contig + '\t' + str(length) + '\t' + gc + '\t' + n_content + '\t' + str(cov) + '\t' + contig_hash + '\n')
+
+# Count the last batch of contigs missing from the cache
+if k_mer_cache_dir and batch_hashes:
+	counting_start_time = time.time()
+	print_worker_stats(k_mer_cache.add(batch_hashes, batch_sequences, processors))
+	counting_seconds += time.time() - counting_start_time
+	number_counted += len(batch_hashes)
+
+output.close()
+print('Read {} contigs of at least {} bp in {} seconds'.format(number_contigs, length_cutoff, round(time.time() - start_time, 2)))
+if k_mer_cache_dir:
+	print('Counted {}-mers for {} of {} contigs ({} found in {}) in {} seconds'.format(k_mer_size, number_counted, number_contigs, number_contigs - number_counted, k_mer_cache_dir, round(counting_seconds, 2)))
+
+if filtered_assembly_path:
+	filtered_assembly.close()
+	with open(filtered_assembly_path + '.fai', 'w') as fai:
+		for fai_line in filtered_fai:
+			fai.write(fai_line + '\n')
@@ -36,7 +36,8 @@ import shutil
 
 import pandas as pd
 from argparse import ArgumentParser
-from Bio import SeqIO
+
+import fasta_functions
 
 
 PIPELINE = os.path.dirname(os.path.realpath(__file__))
@@ -271,13 +272,26 @@ def check_dbs(db_path, update=False):
                 prepare_databases(outdir=db_path, db=db, update=update)
 
 
-def length_trim(fasta_path, length_cutoff):
+def contig_table_command(assembly_path, contig_tab_fpath, coverage_table):
+    contig_table_script = os.path.join(PIPELINE, "make_contig_features.py")
+    cmd = "{} -a {} -o {}".format(
+        contig_table_script, assembly_path, contig_tab_fpath
+    )
+    if coverage_table:
+        cmd += " -c {}".format(coverage_table)
+    elif single_genome_mode:
+        cmd += " -n"
+    return cmd
+
+
+def length_trim(fasta_path, length_cutoff, coverage_table):
     input_fname, ext = os.path.splitext(os.path.basename(fasta_path))
-    # Trim the length of fasta file
+    # Trim the length of fasta file, making the contig table of the trimmed assembly in the same pass
     outfname = input_fname + ".filtered" + ext
     outfile_path = os.path.join(output_dir, outfname)
-    script = os.path.join(PIPELINE, "fasta_length_trim.pl")
-    cmd = " ".join(map(str, [script, fasta_path, length_cutoff, outfile_path]))
+    contig_tab_fpath = os.path.join(output_dir, input_fname + ".filtered.tab")
+    cmd = contig_table_command(fasta_path, contig_tab_fpath, coverage_table)
+    cmd += " -l {} -f {}".format(length_cutoff, outfile_path)
     run_command(cmd)
     return outfile_path
 
@@ -356,17 +370,11 @@ def run_taxonomy(
 ):  # Have to update this
     assembly_fname, _ = os.path.splitext(os.path.basename(assembly_path))
     contig_tab_fpath = os.path.join(output_dir, assembly_fname + ".tab")
-    contig_table_script = os.path.join(PIPELINE, "make_contig_table.py")
-    # Only make the contig table if it doesn't already exist
+    # Only make the contig table if it doesn't already exist (it is usually made by length_trim)
     if not os.path.isfile(contig_tab_fpath):
-        cmd = "{} -a {} -o {}".format(
-            contig_table_script, assembly_path, contig_tab_fpath
+        run_command(
+            contig_table_command(assembly_path, contig_tab_fpath, coverage_table)
         )
-        if coverage_table:
-            cmd += " -c {}".format(coverage_table)
-        elif single_genome_mode:
-            cmd += " -n"
-        run_command(cmd)
     if bgcs_path:
         mask_bgcs_script = os.path.join(PIPELINE, "mask_bgcs.py2.7")
         cmd = "{} --bgc {} --orfs {} --lca {}"
@@ -538,7 +546,7 @@ if args["update"]:
 
 filtered_assembly = os.path.join(output_dir, "{}.filtered.fasta".format(fasta_fname))
 if not os.path.isfile(filtered_assembly):
-    filtered_assembly = length_trim(fasta_path, length_cutoff)
+    filtered_assembly = length_trim(fasta_path, length_cutoff, cov_table)
 
 if not os.path.isfile(prodigal_output + ".faa"):
     print("Prodigal output not found. Running prodigal...")
@@ -594,30 +602,41 @@ else:
 
 # Split the original contigs into sets for each kingdom
 taxonomy_pd = pd.read_table(taxonomy_table)
-categorized_seq_objects = {}
-all_seq_records = {}
+categorized_contigs = {}
 
-# Load fasta file
-for seq_record in SeqIO.parse(filtered_assembly, "fasta"):
-    all_seq_records[seq_record.id] = seq_record
+# Index fasta file, so that sequences are read one at a time as they are written
+assembly_index = fasta_functions.FastaIndex(filtered_assembly)
 
+contig_kingdoms = {}
 for i, row in taxonomy_pd.iterrows():
     kingdom = row["kingdom"]
     contig = row["contig"]
-    if contig not in all_seq_records:
+    if contig not in assembly_index:
         # Using filtered assembly, taxonomy.tab contains contigs not filtered
         print("{0} below length filter, skipping.".format(contig))
         continue
-    if kingdom in categorized_seq_objects:
-        categorized_seq_objects[kingdom].append(all_seq_records[contig])
+    contig_kingdoms[contig] = kingdom
+
+# Contigs are written in assembly order, with their full header lines
+for contig in assembly_index:
+    if contig not in contig_kingdoms:
+        continue
+    kingdom = contig_kingdoms[contig]
+    if kingdom in categorized_contigs:
+        categorized_contigs[kingdom].append(contig)
     else:
-        categorized_seq_objects[kingdom] = [all_seq_records[contig]]
+        categorized_contigs[kingdom] = [contig]
 
 # Now we write the component fasta files
 if not single_genome_mode:
-    for kingdom in categorized_seq_objects:
-        seq_list = categorized_seq_objects[kingdom]
+    for kingdom in categorized_contigs:
         output_path = os.path.join(output_dir, "{}.fasta".format(kingdom))
-        SeqIO.write(seq_list, output_path, "fasta")
+        with open(output_path, "wb") as output_fasta:
+            for contig in categorized_contigs[kingdom]:
+                fasta_functions.write_fasta(
+                    output_fasta,
+                    assembly_index.header(contig),
+                    assembly_index.fetch(contig),
+                )
 
 print("Done!")
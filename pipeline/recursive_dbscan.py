@@ -19,22 +19,24 @@
 
 import pandas as pd
 from sklearn.cluster import DBSCAN
-from scipy import stats
 import sys
-import copy
 import numpy as np
 import numbers
 import math
 import csv
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.Alphabet import IUPAC
-from tsne import bh_sne
-from sklearn import decomposition
 import os
+import platform
+import resource
+import shutil
 #import statistics
 import argparse
 import logging
+import multiprocessing
+import time
+import dbscan_functions
+import embedding_functions
+import fasta_functions
+import kmer_functions
 
 def run_BH_tSNE(table, do_pca=True):
 
@@ -45,92 +47,141 @@ def run_BH_tSNE(table, do_pca=True):
 	# Note - currently doesn't handle cases where PCA dimensions and perplexity set too high
 
 	# We make a submatrix, consisting of the contigs in the table
-	k_mer_counts_submatrix = list()
-	for i,row in table.iterrows():
-		contig = row['contig']
-		k_mer_counts_submatrix.append(k_mer_dict[contig])
+	submatrix_rows = [ k_mer_index[contig] for contig in table['contig'] ]
 
-	normalized_k_mer_submatrix = normalizeKmers(k_mer_counts_submatrix)
+	# Adjust perplexity according to the number of data points
+	# Took logic from tsne source code
+	if (len(submatrix_rows) - 1) < (3 * perplexity)  :
+		perplexity = (float(len(submatrix_rows) - 1) / 3) - 1
+
+	# Embeddings are cached by the contigs (names and sequences), and the parameters that change them
+	if not ((len(submatrix_rows) > pca_dimensions) and (do_pca == True)):
+		pca_dimensions = 0
+	# Sparse counts always get a truncated SVD, so --pca_mode doesn't change their embedding
+	cache_key = embedding_functions.embedding_key(table['contig'], [ contig_hashes[row] for row in submatrix_rows ], embedding_method,\
+		k_mer_size, pca_dimensions, perplexity, embedding_seed, 'sparse svds' if use_sparse_counts else pca_mode)
+	cached_model_path = embedding_functions.pca_model_cache_path(embedding_cache_dir, cache_key)
+	cached_coordinates = embedding_functions.read_cached_embedding(embedding_cache_dir, cache_key)
+	if cached_coordinates is not None:
+		logger.info('run_BH_tSNE: Using the cached {} embedding {}'.format(embedding_method, embedding_functions.embedding_cache_path(embedding_cache_dir, cache_key)))
+		# The PCA model is passed on to ML_recruitment.py. A model left by an earlier run is removed
+		# if there is none cached, so that ML_recruitment.py does its own PCA rather than use it
+		if os.path.isfile(cached_model_path):
+			shutil.copyfile(cached_model_path, pca_model_path)
+		elif os.path.isfile(pca_model_path):
+			os.remove(pca_model_path)
+		table['bh_tsne_x'] = pd.Series(cached_coordinates[:, 0].astype(np.float64), index = table.index)
+		table['bh_tsne_y'] = pd.Series(cached_coordinates[:, 1].astype(np.float64), index = table.index)
+		return
 
 	# PCA
+	# fit_pca reads the rows of the table from k_mer_counts in chunks, rather than from a copy of them, and
+	# normalizes them one chunk at a time when the normalized matrix is too large to hold in memory (see --pca_mode)
 
-	if (len(normalized_k_mer_submatrix) > pca_dimensions) and (do_pca == True):
+	if pca_dimensions:
 		logger.info('run_BH_tSNE: Principal component analysis')
-		pca = decomposition.PCA(n_components=pca_dimensions)
-		pca_matrix = pca.fit_transform(normalized_k_mer_submatrix)
+		pca_start_time = time.time()
+		X, pca_model = kmer_functions.fit_pca(k_mer_counts, pca_dimensions, pca_mode, submatrix_rows)
+		logger.info('run_BH_tSNE: PCA of {} points and {} dimensions took {:.1f} s ({})'.format(len(X), len(pca_model['columns']), time.time() - pca_start_time, pca_model['solver']))
+		# The model is kept so that ML_recruitment.py can project the k-mer matrix without another PCA
+		kmer_functions.write_pca_model(pca_model_path, pca_model, matrix_k_mers)
+		if not os.path.isdir(embedding_cache_dir):
+			os.makedirs(embedding_cache_dir)
+		shutil.copyfile(pca_model_path, cached_model_path)
 	else:
 		logger.info('run_BH_tSNE: Principle component analysis step skipped')
+		# Without PCA there are only a few contigs, so their counts are copied out
+		normalized_k_mer_submatrix = kmer_functions.normalize_kmers(k_mer_counts[submatrix_rows])
+		if isinstance(normalized_k_mer_submatrix, kmer_functions.SparseCLR):
+			X = normalized_k_mer_submatrix.toarray()
+		else:
+			X = np.array(normalized_k_mer_submatrix)
+		if os.path.isfile(pca_model_path):
+			os.remove(pca_model_path)
 
-	# BH-tSNE
-	logger.info('run_BH_tSNE: BH-tSNE')
-
-	# Adjust perplexity according to the number of data points
-	# Took logic from tsne source code
-	if (len(normalized_k_mer_submatrix) - 1) < (3 * perplexity)  :
-		perplexity = (float(len(normalized_k_mer_submatrix) - 1) / 3) - 1
-
-	logger.info(str(len(normalized_k_mer_submatrix)) + ' data points')
-	logger.info(str(len(normalized_k_mer_submatrix[0])) + ' dimensions')
-
-	if (len(normalized_k_mer_submatrix) > pca_dimensions) and (do_pca == True):
-		X = np.array(pca_matrix)
-	else:
-		X = np.array(normalized_k_mer_submatrix)
-	bh_tsne_matrix = bh_sne(X, d=2, perplexity=perplexity, theta=0.5)
+	# BH-tSNE (or the embedding chosen with --embedding)
+	logger.info('run_BH_tSNE: {} embedding'.format(embedding_method))
 
-	# We will add bh_tsne_x and bh_tsne_y columns to the contig table
+	logger.info(str(len(X)) + ' data points')
+	logger.info(str(X.shape[1]) + ' dimensions')
 
-	bh_tsne_x = list()
-	bh_tsne_y = list()
+	embedding_start_time = time.time()
+	bh_tsne_matrix = embedding_functions.embed(X, embedding_method, perplexity, embedding_threads, embedding_seed)
+	logger.info('run_BH_tSNE: {} embedding of {} points took {:.1f} s ({} threads, seed {})'.format(embedding_method, len(X), time.time() - embedding_start_time, embedding_threads, embedding_seed))
 
-	for i in range(0, len(bh_tsne_matrix)):
-		bh_tsne_x.append(bh_tsne_matrix[i][0])
-		bh_tsne_y.append(bh_tsne_matrix[i][1])
+	# Coordinates are stored as float32, and we use the stored values so that clustering is the same
+	# whether or not the embedding comes from the cache
+	embedding_functions.write_cached_embedding(embedding_cache_dir, cache_key, bh_tsne_matrix)
+	bh_tsne_matrix = bh_tsne_matrix.astype(np.float32).astype(np.float64)
 
-	table['bh_tsne_x'] = pd.Series(bh_tsne_x, index = table.index)
-	table['bh_tsne_y'] = pd.Series(bh_tsne_y, index = table.index)
+	# We will add bh_tsne_x and bh_tsne_y columns to the contig table, whichever embedding was used
+	table['bh_tsne_x'] = pd.Series(bh_tsne_matrix[:, 0], index = table.index)
+	table['bh_tsne_y'] = pd.Series(bh_tsne_matrix[:, 1], index = table.index)
 
-def runDBSCANs(table, dimensions, hmm_dictionary, domain, completeness_cutoff, purity_cutoff):
+def runDBSCANs(rows, dimensions, marker_counts, domain, completeness_cutoff, purity_cutoff):
 	# Carry out DBSCAN, starting at eps=0.3 and continuing until there is just one group
+	# rows are the rows of the master table (and of contig_points) to cluster. Returns the information on
+	# complete and pure clusters, the rows in those clusters with their cluster labels, and the remaining rows
+	if dbscan_engine == 'hdbscan':
+		return runHDBSCAN(rows, dimensions, marker_counts, domain, completeness_cutoff, purity_cutoff)
 	current_eps = 0.3
 	#db_tables = {} # Will be keyed by eps
 	number_of_clusters = float('inf')
 	current_step = 0.1
 	number_of_tables = {}
 	best_median = 0
-	best_table_so_far = None
+	best_labels_so_far = None
 	best_cluster_info = dict()
 	number_rounds_with_zero_clusters = 0
 	some_clusters_found = False
+	points = dbscan_points(rows, dimensions)
+	# With the sweep engine the clusters for every eps come from one single-linkage tree of the points
+	if dbscan_engine == 'sweep':
+		sweep = dbscan_functions.SingleLinkageSweep(points)
+	else:
+		sweep = None
+	# Marker counts of the contigs in rows, in the same order
+	table_markers = marker_counts.matrix[rows]
+
+	if eps_search == 'adaptive':
+		# The number of clusters at any eps is read from a single-linkage tree, whichever engine gives the labels
+		cluster_counts = sweep or dbscan_functions.SingleLinkageSweep(points)
+		evaluations = dict() # Labels, cluster information and median completeness, keyed by number of clusters
+
+		def score(eps):
+			logger.info('EPS: ' + str(eps))
+			db_labels = dbscan_simple(points, eps, sweep)
+			cluster_info, completenessList, current_median = assessClusters(db_labels, table_markers, domain, completeness_cutoff, purity_cutoff)
+			logger.info('Median: ' + str(current_median))
+			logger.info('No. complete and pure: ' + str(len(completenessList)))
+			evaluations[cluster_counts.number_of_clusters(eps)] = (db_labels, cluster_info, current_median)
+			return current_median
+
+		best_eps, number_evaluated = dbscan_functions.adaptive_eps_search(score, cluster_counts.number_of_clusters, current_eps,\
+			max(current_eps, cluster_counts.single_cluster_eps()), eps_budget)
+		best_labels_so_far, best_cluster_info, best_median = evaluations[cluster_counts.number_of_clusters(best_eps)]
+		linear_evaluations = dbscan_functions.linear_schedule_length(cluster_counts.number_of_clusters)
+		logger.info('Adaptive eps search: best eps ' + str(best_eps) + ' after ' + str(number_evaluated) + ' evaluations, ' + \
+			str(linear_evaluations - number_evaluated) + ' fewer than the ' + str(linear_evaluations) + ' of the linear schedule (up to one cluster)')
+		number_of_clusters = 1
+
 	while(number_of_clusters > 1):
 		logger.info('EPS: ' + str(current_eps))
-		dbscan_output_pd = dbscan_simple(table, current_eps, dimensions)
+		db_labels = dbscan_simple(points, current_eps, sweep)
 
 		# Assess table
-		cluster_info = getClusterInfo(dbscan_output_pd, hmm_dictionary, domain)
-
-		# Determine median completeness
-		completenessList = []
-		for cluster in cluster_info:
-			completeness = cluster_info[cluster]['completeness']
-			purity = cluster_info[cluster]['purity']
-			if completeness > completeness_cutoff and purity > purity_cutoff:
-				completenessList.append(completeness)
-		if completenessList:
-			current_median = np.median(completenessList)
-		else:
-			current_median = 0
+		cluster_info, completenessList, current_median = assessClusters(db_labels, table_markers, domain, completeness_cutoff, purity_cutoff)
 
 		if current_median >= best_median:
 			best_median = current_median
-			best_table_so_far = dbscan_output_pd
+			best_labels_so_far = db_labels
 			best_cluster_info = cluster_info
 
 		logger.info('Median: ' + str(current_median))
 		logger.info('No. complete and pure: ' + str(len(completenessList)))
 
 		# Count the number of clusters
-		number_of_clusters = countClusters(dbscan_output_pd)
+		number_of_clusters = countClusters(db_labels)
 		if number_of_clusters in number_of_tables:
 			number_of_tables[number_of_clusters] += 1
 		else:
@@ -178,77 +229,88 @@ def runDBSCANs(table, dimensions, hmm_dictionary, domain, completeness_cutoff, p
 		else:
 			other_clusters[cluster] = 1
 
-	# Subset the data frame
-	subset_other_db_table = copy.deepcopy(best_table_so_far)
-
-	for cluster in complete_and_pure_clusters:
-		subset_other_db_table = subset_other_db_table[subset_other_db_table['db_cluster'] != cluster]
-
-	# We now drop the db_cluster column
-	subset_other_db_table = subset_other_db_table.drop('db_cluster', 1)
-	unclustered = subset_other_db_table
-
 	# We now make a data structure containing cluster information for complete clusters only
 	output_cluster_info = {}
-	output_contig_cluster = {}
 	for cluster in complete_and_pure_clusters:
 		output_cluster_info[cluster] = {'completeness': best_cluster_info[cluster]['completeness'], 'purity': best_cluster_info[cluster]['purity']}
 
-	# Now we grab contig names from the best db table
-	for i, row in best_table_so_far.iterrows():
-		contig = row['contig']
-		cluster = row['db_cluster']
-		if cluster in complete_and_pure_clusters:
-			output_contig_cluster[contig] = cluster
-
-	return output_cluster_info, output_contig_cluster, unclustered
+	# Split the rows, keeping their order, between the complete and pure clusters and the rest
+	in_complete_cluster = np.isin(best_labels_so_far, list(complete_and_pure_clusters.keys()))
+	clustered_rows = rows[in_complete_cluster]
+	clustered_labels = best_labels_so_far[in_complete_cluster]
+	unclustered_rows = rows[~in_complete_cluster]
+
+	return output_cluster_info, clustered_rows, clustered_labels, unclustered_rows
+
+def runHDBSCAN(rows, dimensions, marker_counts, domain, completeness_cutoff, purity_cutoff):
+	# Builds the HDBSCAN condensed cluster tree of the rows once, and takes the highest clusters in it that are complete
+	# and pure, instead of sweeping eps. Returns the same as runDBSCANs
+	points = dbscan_points(rows, dimensions)
+	table_markers = marker_counts.matrix[rows]
+	cluster_tree = dbscan_functions.CondensedTree(points, min_cluster_size)
+	selected_cluster_info = list()
+
+	def complete_and_pure(cluster_points):
+		cluster_info = getClusterInfo(np.zeros(len(cluster_points), dtype=int), table_markers[cluster_points], domain)[0]
+		if cluster_info['completeness'] > completeness_cutoff and cluster_info['purity'] > purity_cutoff:
+			selected_cluster_info.append(cluster_info)
+			return True
+		return False
+
+	selected_clusters = cluster_tree.select_clusters(complete_and_pure)
+	logger.info('HDBSCAN: ' + str(len(selected_clusters)) + ' complete and pure clusters out of ' + str(len(cluster_tree.clusters)) + ' in the condensed tree')
+
+	# Number the clusters in the order of their first row, as DBSCAN does
+	labels = np.full(len(rows), -1, dtype=int)
+	output_cluster_info = {}
+	cluster_order = sorted(range(len(selected_clusters)), key=lambda cluster: selected_clusters[cluster].min())
+	for label, cluster in enumerate(cluster_order):
+		labels[selected_clusters[cluster]] = label
+		output_cluster_info[label] = selected_cluster_info[cluster]
 
-def dbscan_simple(table, eps, dimensions):
-	table_copy = copy.deepcopy(table)
-	table_size = len(table.index)
-	#logger.debug('dbscan_simple, eps: ' + str(eps) + ', table_size: ' + str(table_size))
-	# Delete db_cluster column
-	if 'db_cluster' in table_copy:
-		table_copy.drop('db_cluster')
+	in_complete_cluster = labels >= 0
+	return output_cluster_info, rows[in_complete_cluster], labels[in_complete_cluster], rows[~in_complete_cluster]
 
+def dbscan_points(rows, dimensions):
 	# Make a matrix
 	if dimensions == 2:
-		X = table_copy[['bh_tsne_x', 'bh_tsne_y']].values
+		return contig_points[rows, :2]
 	elif dimensions == 3:
-		X = table_copy[['bh_tsne_x', 'bh_tsne_y', 'cov']].values
-	db = DBSCAN(eps=eps, min_samples=1).fit(X)
-
-	table_copy['db_cluster'] = db.labels_
+		return contig_points[rows, :3]
+
+def dbscan_simple(points, eps, sweep=None):
+	# Returns the DBSCAN cluster labels of the points at eps
+	if sweep is not None:
+		# Same labels as DBSCAN(min_samples=1), see dbscan_functions.py
+		return sweep.labels(eps)
+	db = DBSCAN(eps=eps, min_samples=1).fit(points)
+	return db.labels_
+
+def assessClusters(db_labels, table_markers, domain, completeness_cutoff, purity_cutoff):
+	# Returns the cluster information, the completeness of complete and pure clusters, and their median completeness
+	cluster_info = getClusterInfo(db_labels, table_markers, domain)
+
+	# Determine median completeness
+	completenessList = []
+	for cluster in cluster_info:
+		completeness = cluster_info[cluster]['completeness']
+		purity = cluster_info[cluster]['purity']
+		if completeness > completeness_cutoff and purity > purity_cutoff:
+			completenessList.append(completeness)
+	if completenessList:
+		current_median = np.median(completenessList)
+	else:
+		current_median = 0
 
-	return table_copy
+	return cluster_info, completenessList, current_median
 
-def countClusters(pandas_table):
-	clusters = {}
-	for i, row in pandas_table.iterrows():
-		cluster = row['db_cluster']
-		if cluster not in clusters:
-			clusters[cluster] = 1
-		else:
-			clusters[cluster] += 1
-	number_of_clusters = len(list(clusters.keys()))
+def countClusters(db_labels):
+	number_of_clusters = len(np.unique(db_labels))
 	return number_of_clusters
 
-def getClusterInfo(pandas_table, hmm_dictionary, life_domain):
-	marker_totals = {}
-	for i, row in pandas_table.iterrows():
-		contig = row['contig']
-		cluster = row['db_cluster']
-		if cluster not in marker_totals:
-			marker_totals[cluster] = {}
-
-		if contig not in hmm_dictionary:
-			continue
-
-		for pfam in hmm_dictionary[contig]:
-			if pfam in marker_totals[cluster]:
-				marker_totals[cluster][pfam] += hmm_dictionary[contig][pfam]
-			else:
-				marker_totals[cluster][pfam] = hmm_dictionary[contig][pfam]
+def getClusterInfo(db_labels, table_markers, life_domain):
+	# table_markers holds the marker counts of the contigs labelled in db_labels (see dbscan_functions.MarkerCounts)
+	clusters, unique_marker_counts, single_copy_marker_counts = dbscan_functions.cluster_marker_counts(table_markers, db_labels)
 
 	expected_number = 139
 	if life_domain == 'archaea':
@@ -256,15 +318,7 @@ def getClusterInfo(pandas_table, hmm_dictionary, life_domain):
 
 	cluster_details = {} # Will hold completeness, purity
 
-	for cluster in marker_totals:
-		total_unique_markers = len(marker_totals[cluster])
-		# total_marker_count = 0
-		num_single_copy_markers = 0
-		for marker in marker_totals[cluster]:
-			# total_marker_count += marker_totals[cluster][marker]
-			if marker_totals[cluster][marker] == 1:
-				num_single_copy_markers += 1
-
+	for cluster, total_unique_markers, num_single_copy_markers in zip(clusters.tolist(), unique_marker_counts.tolist(), single_copy_marker_counts.tolist()):
 		completeness = (float(total_unique_markers) / expected_number) * 100
 		# Protect from divide by zero
 		if total_unique_markers == 0:
@@ -277,74 +331,26 @@ def getClusterInfo(pandas_table, hmm_dictionary, life_domain):
 	return cluster_details
 
 
-def revcomp( string ):
-	trans_dict = { 'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C' }
-	complement_list = list()
-
-	for i in range(0, len(string) ):
-		if string[i] in trans_dict:
-			complement_list.append(trans_dict[string[i]])
-		else:
-			return -1
-
-	return ''.join(reversed(complement_list))
-
-def normalizeKmers(count_matrix): # list of lists, not a np matrix
-	# We now remove all the k-mers where all counts are '1'
-	logger.info('Trimming k-mers')
-	columns_to_delete = dict()
-	for i in range(0, len(unique_k_mers.keys())):
-		non_zero_counts = 0
-		for j in range(0, len(count_matrix)):
-			if count_matrix[j][i] > 1:
-				non_zero_counts += 1
-
-		if non_zero_counts == 0:
-			columns_to_delete[i] = 1
-
-
-	filtered_contig_k_mer_counts = list()
-	for i in range(0, len(count_matrix)):
-		new_row = list()
-		for j in range(0, len(unique_k_mers.keys())):
-			if j not in columns_to_delete:
-				new_row.append(count_matrix[i][j])
-		filtered_contig_k_mer_counts.append(new_row)
-
-	# 3. Normalization
-	logger.info('Normalizing counts')
-
-	k_mer_frequency_matrix = list()
-
-	for count_list in filtered_contig_k_mer_counts:
-		total_count = 0
-		for count in count_list:
-			total_count += count
-
-		normalized_list = list()
-		for count in count_list:
-			normalized_list.append(float(count)/total_count)
-
-		# Now we calculate the Centered log-ratio (CLR) transformation
-		# See Aitchison, J. The Statistical Analysis of Compositional Data (1986) and
-		# Pawlowsky-Glahn, Egozcue, Tolosana-Delgado. Lecture Notes on Compositional Data Analysis (2011)
-		geometric_mean = stats.mstats.gmean(normalized_list)
-		clr_list = list()
-
-		for item in normalized_list:
-			intermediate_value = item / geometric_mean
-			clr_list.append(math.log(intermediate_value))
-
-		k_mer_frequency_matrix.append(clr_list)
-
-	return k_mer_frequency_matrix
-
 parser = argparse.ArgumentParser(description="Perform initial clustering via BH-tSNE and DBSCAN.")
 parser.add_argument('-t','--input_table', help='Master contig table. Optionally can contain taxonomy data', required=True)
 parser.add_argument('-a','--assembly_fasta', help='Assembly fasta', required=True)
 #parser.add_argument('-o','--output_table', help='Path to output table', required=True)
 parser.add_argument('-d','--output_dir', help='Path to output directory', default='.')
 parser.add_argument('-k','--kingdom', help='Kingdom to consider (archaea|bacteria)', choices=['bacteria','archaea'], default = 'bacteria')
+parser.add_argument('-p','--processors', help='Number of processors to use', type=int, default=1)
+parser.add_argument('--k_mer_size', help='Length of k-mers to count (sizes from {} up are stored as sparse matrices)'.format(kmer_functions.SPARSE_K_MER_SIZE), type=int, choices=range(3, 9), default=5)
+parser.add_argument('--k_mer_cache', help='Directory of k-mer counts cached by sequence hash, can be shared between runs (default: <output_dir>/k-mer_cache)')
+parser.add_argument('--embedding', help='Method used to embed k-mer features in 2D: bhsne (Barnes-Hut t-SNE), fftsne (multithreaded FFT-accelerated t-SNE, needs openTSNE) or umap (needs umap-learn)', choices=embedding_functions.EMBEDDING_METHODS, default='bhsne')
+parser.add_argument('--embedding_threads', help='Number of threads for the embedding (default: --processors). bhsne is single threaded', type=int)
+parser.add_argument('--embedding_seed', help='Random seed for the embedding, for reproducible coordinates', type=int)
+parser.add_argument('--embedding_cache', help='Directory of embeddings cached by contigs and parameters, can be shared between runs (default: <output_dir>/embedding_cache)')
+parser.add_argument('--pca_mode', help='How PCA is done: full SVD, randomized SVD, or incremental (in chunks of rows, for matrices too large to normalize in memory). auto chooses by matrix size. Sparse counts (k-mer sizes from {} up) always get a truncated SVD'.format(kmer_functions.SPARSE_K_MER_SIZE), choices=kmer_functions.PCA_MODES, default='auto')
+parser.add_argument('--dbscan_engine', help='sweep reads the DBSCAN clusters for every eps from one single-linkage tree, sklearn runs DBSCAN for each eps (same clusters, slower), hdbscan takes the complete and pure clusters from one HDBSCAN condensed cluster tree without an eps search', choices=['sweep', 'sklearn', 'hdbscan'], default='sweep')
+parser.add_argument('--eps_search', help='linear tries eps from 0.3 in steps of 0.1 until there is one cluster, adaptive brackets the best median completeness on a grid and refines it with golden-section steps', choices=['linear', 'adaptive'], default='linear')
+parser.add_argument('--eps_budget', help='Number of clusterings to try per round with --eps_search adaptive', type=int, default=16)
+parser.add_argument('--min_cluster_size', help='Smallest number of contigs in a cluster of the condensed tree with --dbscan_engine hdbscan', type=int, default=5)
+parser.add_argument('--resume', help='Continue binning from the checkpoints in <output_dir>/checkpoints, left by a run that was stopped', action='store_true')
+parser.add_argument('--k_mer_tsv', help='Write k-mer_matrix as a tab-delimited table (as made by earlier versions) instead of the binary format', action='store_true')
 
 args = vars(parser.parse_args())
 
@@ -353,6 +359,26 @@ input_fasta_path = args['assembly_fasta']
 output_dir_path = args['output_dir']
 output_table_path = output_dir_path + '/recursive_dbscan_output.tab'
 domain = args['kingdom']
+processors = min(args['processors'], multiprocessing.cpu_count())
+write_tsv_matrix = args['k_mer_tsv']
+k_mer_size = args['k_mer_size']
+k_mer_cache_dir = args['k_mer_cache'] or os.path.join(output_dir_path, 'k-mer_cache')
+embedding_method = args['embedding']
+embedding_threads = args['embedding_threads'] or processors
+embedding_seed = args['embedding_seed']
+embedding_cache_dir = args['embedding_cache'] or os.path.join(output_dir_path, 'embedding_cache')
+pca_mode = args['pca_mode']
+dbscan_engine = args['dbscan_engine']
+eps_search = args['eps_search']
+eps_budget = args['eps_budget']
+min_cluster_size = args['min_cluster_size']
+resume = args['resume']
+checkpoint_dir = os.path.join(output_dir_path, 'checkpoints')
+pca_model_path = os.path.join(output_dir_path, 'k-mer_pca.npz')
+
+if not embedding_functions.is_available(embedding_method):
+	print('Error! --embedding {} needs the {} package, which could not be imported'.format(embedding_method, embedding_functions.EMBEDDING_PACKAGES[embedding_method]))
+	exit(1)
 
 #logger
 logger = logging.getLogger('recursive_dbscan.py')
@@ -365,95 +391,71 @@ console.setFormatter(formatter)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(console)
 
-input_master_table = pd.read_csv(input_table_path, sep='\t')
+# sha1 is read as text, so that a hash made only of digits isn't turned into a number
+input_master_table = pd.read_csv(input_table_path, sep='\t', dtype={'sha1': str})
 input_master_table['bh_tsne_x'] = 0
 input_master_table['bh_tsne_y'] = 0
 
-# Load fasta sequences
-assembly_seqs = {}
-for seq_record in SeqIO.parse(input_fasta_path, 'fasta'):
-	assembly_seqs[str(seq_record.id)] = seq_record
+# Index the fasta file, sequences are read from disk when they are needed
+# make_contig_features.py writes a .fai index next to the filtered assembly, which is used if it is up to date
+assembly_index = fasta_functions.FastaIndex(input_fasta_path, input_fasta_path + '.fai')
 
 # Count K-mer frequencies
-k_mer_size = 5
 matrix_file = output_dir_path + '/k-mer_matrix'
-k_mer_dict = dict() # Holds lists of k-mer counts, keyed by contig name
-
-count = 0
-unique_k_mers = dict()
-
-DNA_letters = ['A', 'T', 'C', 'G']
-all_k_mers = list(DNA_letters)
-for i in range(1, k_mer_size):
-	new_list = list()
-	for current_seq in all_k_mers:
-		for char in DNA_letters:
-			new_list.append(current_seq + char)
-	all_k_mers = new_list
-
-# Now we trim k-mers and put them in the dictionary
-for k_mer in all_k_mers:
-	k_mer_reverse = revcomp(k_mer)
-	if (k_mer not in unique_k_mers) and (k_mer_reverse not in unique_k_mers):
-		unique_k_mers[k_mer] = count
-		count += 1
-
-if os.path.isfile(matrix_file):
-	logger.info("K-mer matrix already exists!")
-	logger.info("Continuing to next step...")
-
-	# Now we load the k-mer matrix
-	with open(matrix_file) as matrix:
-		for i,line in enumerate(matrix):
-			if i > 0:
-				line_list = line.rstrip().split('\t')
-				contig = line_list.pop(0)
-				line_list = [ int(x) for x in line_list ]
-				k_mer_dict[contig] = line_list
+k_mer_index = dict() # Holds the row of each contig in k_mer_counts, keyed by contig name
+
+# All the possible k-mers (discounting revcomps), in the order of the k-mer matrix columns
+matrix_k_mers = kmer_functions.canonical_kmers(k_mer_size)
+# Longer k-mers are counted into a sparse matrix, as most of them are not found in a given contig
+use_sparse_counts = k_mer_size >= kmer_functions.SPARSE_K_MER_SIZE
+
+# Counts are cached by sequence hash, so only contigs that have not been seen before (in this or any
+# other assembly sharing the cache directory) are counted
+logger.info('Counting {}-mers, using the cache in {}'.format(k_mer_size, k_mer_cache_dir))
+# The sequence hashes come from the sha1 column written by make_contig_features.py, and the assembly
+# is only read again to hash the sequences if the input table doesn't have them
+# The table is checked against the assembly by contig length, so that a table made from another assembly
+# isn't used to look up counts. Contigs missing from the cache have their hashes checked against their
+# sequences before they are added to it (see kmer_functions.KmerCache.add)
+contig_names = list(assembly_index)
+table_hashes = dict()
+if 'sha1' in input_master_table.columns:
+	table_hashes = dict(zip(input_master_table['contig'], input_master_table['sha1']))
+if all(isinstance(table_hashes.get(contig_name), str) for contig_name in contig_names):
+	table_lengths = dict(zip(input_master_table['contig'], input_master_table['length']))
+	for contig_name in contig_names:
+		if int(table_lengths[contig_name]) != assembly_index.length(contig_name):
+			logger.error('Contig {} is {} bp in {} but {} bp in {}, the table was not made from this assembly'.format(contig_name,\
+				table_lengths[contig_name], input_table_path, assembly_index.length(contig_name), input_fasta_path))
+			exit(1)
+	contig_hashes = [ table_hashes[contig_name] for contig_name in contig_names ]
 else:
-	# Count k-mers
-	# First we make a dictionary of all the possible k-mers (discounting revcomps)
-	# Under each key is an index to be used in the subsequent lists
-	# The order of the indices depends on the order k-mers were encountered while making the dictionary
-	logger.info('Counting k-mers')
-
-	for contig_name in assembly_seqs:
-		contig_seq = str(assembly_seqs[contig_name].seq)
-		# Initialize the list for the contig to be all 1s - as we can't have zero values in there for CLR later
-		list_size = len(unique_k_mers.keys())
-		current_contig_k_mer_counts = [1 for k in range(0, list_size)]
-
-		for j in range(0, (len(contig_seq) - k_mer_size)):
-			k_mer = contig_seq[j:j + k_mer_size]
-			k_mer_reverse = revcomp(k_mer)
-
-			# Find appropriate index
-			# Note - this part naturally ignores any k_mers with weird characters
-			if k_mer in unique_k_mers:
-				index = unique_k_mers[k_mer]
-				current_contig_k_mer_counts[index] += 1
-			elif k_mer_reverse in unique_k_mers:
-				index = unique_k_mers[k_mer_reverse]
-				current_contig_k_mer_counts[index] += 1
-
-		k_mer_dict[contig_name] = current_contig_k_mer_counts
-
-	# Write the file in case we have to do this again
-	matrix = open(matrix_file, 'w')
-
-	# The first line consists of the k-mer headings (left corner is blank because the contig names are listed under it)
-	header_line_list = [''] + sorted(unique_k_mers, key=unique_k_mers.__getitem__)
-	header_line = '\t'.join(header_line_list)
-	matrix.write(header_line + '\n')
-
-	for contig in k_mer_dict:
-		line_list = k_mer_dict[contig]
-		output_list = [contig] + line_list
-		for i, item in enumerate(output_list):
-			output_list[i] = str(item)
-		output_line = '\t'.join(output_list)
-		matrix.write(output_line + '\n')
-	matrix.close()
+	logger.info('No sha1 column for every contig in {}, hashing the sequences of {}'.format(input_table_path, input_fasta_path))
+	contig_hashes = [ kmer_functions.sequence_hash(contig_seq) for contig_name, contig_seq in fasta_functions.read_fasta(input_fasta_path) ]
+contig_sequences = assembly_index.sequences(contig_names)
+
+# Contigs missing from the cache are split between processes in shards of similar total length
+try:
+	k_mer_counts, worker_stats, number_counted = kmer_functions.cached_kmer_counts(k_mer_cache_dir, contig_hashes, contig_sequences, k_mer_size, processors, use_sparse_counts)
+except kmer_functions.SequenceHashError as error:
+	logger.error('The sha1 column of {} does not match {} ({}), remake the table with make_contig_features.py'.format(input_table_path, input_fasta_path, error))
+	exit(1)
+logger.info('{} of {} contigs found in the k-mer cache, {} counted'.format(len(contig_names) - number_counted, len(contig_names), number_counted))
+
+for worker_pid, worker_bp, worker_seconds in worker_stats:
+	logger.info('Worker {}: counted {} bp in {:.1f} s ({:.0f} bp/s)'.format(worker_pid, worker_bp, worker_seconds, worker_bp / max(worker_seconds, 1e-6)))
+
+# Add 1 to every count - as we can't have zero values in there for CLR later
+# Note - the counting naturally ignores any k_mers with weird characters
+# Sparse matrices keep raw counts, and the pseudocount is added during normalization
+if not use_sparse_counts:
+	k_mer_counts += 1
+
+# The k-mer matrix of this assembly is written for ML_recruitment.py
+kmer_functions.write_kmer_matrix(matrix_file, contig_names, matrix_k_mers, k_mer_counts, tsv=write_tsv_matrix)
+
+for i, contig_name in enumerate(contig_names):
+	k_mer_index[contig_name] = i
 
 ### Collate training data for ML steps later
 # We now set up global data structures to be used in supervised machine learning
@@ -462,7 +464,7 @@ else:
 rows_of_interest = list()
 for index, row in input_master_table.iterrows():
 	contig = row['contig']
-	if contig in assembly_seqs:
+	if contig in assembly_index:
 		rows_of_interest.append(index)
 
 master_table = input_master_table.iloc[rows_of_interest]
@@ -476,25 +478,16 @@ taxonomy_matrix = list()
 #for contig in contig_list:
 #	k_mer_counts.append(k_mer_dict[contig])
 
-#normalized_k_mer_matrix = normalizeKmers(k_mer_counts)
+#normalized_k_mer_matrix = kmer_functions.normalize_kmers(k_mer_counts)
 
 
 BH_tSNE_output_file = output_dir_path + '/BH_tSNE_output.tab'
 
-if os.path.isfile(BH_tSNE_output_file):
-	logger.info("BH_tSNE output already exists!")
-	logger.info("Continuing to next step...")
-
-	# Now we load the file
-	master_table = pd.read_csv(BH_tSNE_output_file, sep='\t')
-	master_table['cluster'] = 'unclustered'
-else:
-	run_BH_tSNE(master_table)
-
-	# Write file to disk
-	master_table.to_csv(path_or_buf=BH_tSNE_output_file, sep='\t', index=False, quoting=csv.QUOTE_NONE)
+# Coordinates come from the embedding cache if these contigs have been embedded with the same parameters before
+run_BH_tSNE(master_table)
 
-	master_table['cluster'] = 'unclustered'
+# Write file to disk
+master_table.to_csv(path_or_buf=BH_tSNE_output_file, sep='\t', index=False, quoting=csv.QUOTE_NONE)
 
 contig_markers = {}
 for i, row in master_table.iterrows():
@@ -513,13 +506,21 @@ for i, row in master_table.iterrows():
 		else:
 			contig_markers[contig] = { pfam: 1 }
 
+# Marker counts as a sparse matrix, used to score the clusters at every eps
+marker_counts = dbscan_functions.MarkerCounts(master_table['contig'], contig_markers)
+
 
 
 completeness_cutoff = 20
 purity_cutoff = 90
 round_counter = 0
 global_cluster_info = {}
-local_current_table = copy.deepcopy(master_table)
+
+# Recursive binning works on integer arrays of rows of master_table, rather than copies of the table.
+# contig_points holds the DBSCAN coordinates of every row, and cluster names are written into cluster_column
+contig_points = np.column_stack([ master_table['bh_tsne_x'].values, master_table['bh_tsne_y'].values, master_table['cov'].values ]).astype(np.float64)
+cluster_column = np.array(['unclustered'] * len(master_table.index), dtype=object)
+local_current_rows = np.arange(len(master_table.index))
 
 data_size = len(master_table.index)
 
@@ -528,82 +529,208 @@ if 'kingdom' in master_table.columns:
 else:
 	has_taxonomy_info = False
 
-if has_taxonomy_info and data_size > 50:
-	for dimensions in [2, 3]:
-		taxonomic_levels = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
-		logger.info('Further splitting according to taxonomic classifications')
-		for taxonomic_level in taxonomic_levels:
-			logger.info('Taxonomic level: ' + taxonomic_level)
-			unclustered_table = pd.DataFrame()
-
-			# Make subtables for each type of classification at the current level
-			classification_dict = dict()
-			for i,row in local_current_table.iterrows():
-				classification_dict[row[taxonomic_level]] = 1
-
-			# Skip iteration if the current taxonomic level is empty
-			if not classification_dict:
-				continue
-
-			for classification in classification_dict.keys():
-				logger.info('Examining ' + classification)
-				# Get subset table
-				subset_table = local_current_table.loc[local_current_table[taxonomic_level] == classification] # COPY of local_current_table
-
-				while True:
-					if subset_table.empty:
-						break
-					round_counter += 1
-					logger.info('Running DBSCAN round ' + str(round_counter))
-
-					#db_tables = runDBSCANs(subset_table, dimensions)
-					cluster_information, contig_cluster_dictionary, local_unclustered_table = runDBSCANs(subset_table, dimensions, contig_markers, domain, completeness_cutoff, purity_cutoff)
-
-					subset_table = local_unclustered_table
-
-					if not cluster_information:
-						break
-
-					# Populate the global data structures
-					for	cluster in cluster_information:
-						new_cluster_name = 'DBSCAN' + '_round' + str(round_counter) + '_' + str(cluster)
-						global_cluster_info[new_cluster_name] = cluster_information[cluster]
+def assign_clusters(round_counter, cluster_information, clustered_rows, clustered_labels):
+	# Populate the global data structures
+	for	cluster in cluster_information:
+		new_cluster_name = 'DBSCAN' + '_round' + str(round_counter) + '_' + str(cluster)
+		global_cluster_info[new_cluster_name] = cluster_information[cluster]
+
+	cluster_column[clustered_rows] = [ 'DBSCAN' + '_round' + str(round_counter) + '_' + str(label) for label in clustered_labels.tolist() ]
+
+def bin_partition(rows, dimensions, description, checkpoint_path=None):
+	# Runs DBSCAN rounds on rows until no more complete and pure clusters are found, or no rows are left
+	# Returns the rounds that found clusters, as (cluster_information, clustered_rows, clustered_labels),
+	# the number of rounds run (which includes a last round that found nothing) and the rows left unclustered
+	# Rounds are numbered when they are merged (see merge_partition), so they can run in any process
+	found_rounds = list()
+	rounds_run = 0
+	# The partition is checkpointed after each round that finds clusters, and picks up from there on --resume
+	saved_partition = dbscan_functions.read_checkpoint(checkpoint_path) if checkpoint_path else None
+	if saved_partition is not None and saved_partition['fingerprint'] == fingerprint:
+		found_rounds, rounds_run, rows = saved_partition['found_rounds'], saved_partition['rounds_run'], saved_partition['rows']
+		logger.info('Resuming ' + description + ' after ' + str(rounds_run) + ' rounds')
+	while True:
+		if not len(rows):
+			break
+		rounds_run += 1
+		logger.info('Running DBSCAN round ' + str(rounds_run) + ' of ' + description)
 
-					for contig in contig_cluster_dictionary:
-						new_cluster_name = 'DBSCAN'+ '_round' + str(round_counter) + '_' + str(contig_cluster_dictionary[contig])
-						table_indices = local_current_table[local_current_table['contig'] == contig].index.tolist()
-						master_table.at[table_indices[0], 'cluster'] = new_cluster_name
+		cluster_information, clustered_rows, clustered_labels, rows = runDBSCANs(rows, dimensions, marker_counts, domain, completeness_cutoff, purity_cutoff)
 
-				# Add unclustered_table to combined unclustered dataframe
-				unclustered_table = unclustered_table.append(local_unclustered_table)
+		if not cluster_information:
+			break
 
-			#current_table = copy.deepcopy(unclustered_table)
-			local_current_table = unclustered_table
+		found_rounds.append((cluster_information, clustered_rows, clustered_labels))
+		if checkpoint_path:
+			dbscan_functions.write_checkpoint(checkpoint_path, { 'fingerprint': fingerprint, 'found_rounds': found_rounds, 'rounds_run': rounds_run, 'rows': rows })
+
+	return found_rounds, rounds_run, rows
+
+def bin_partition_task(task):
+	# Pool tasks are (partition number, rows, dimensions, description, checkpoint path)
+	partition_number, rows, dimensions, description, checkpoint_path = task
+	return partition_number, bin_partition(rows, dimensions, description, checkpoint_path)
+
+def merge_partition(round_counter, found_rounds, rounds_run):
+	# Gives the rounds of a partition the round numbers they would have had if the partitions ran one after another
+	for round_number, (cluster_information, clustered_rows, clustered_labels) in enumerate(found_rounds, round_counter + 1):
+		logger.info('DBSCAN round ' + str(round_number) + ': ' + str(len(cluster_information)) + ' complete and pure clusters')
+		assign_clusters(round_number, cluster_information, clustered_rows, clustered_labels)
+		merged_rounds.append((round_number, cluster_information, clustered_rows, clustered_labels))
+	return round_counter + rounds_run
+
+def make_partition_pool(processes):
+	# Workers get the master arrays (contig_points, marker_counts) by forking, so there is no pool if processes
+	# can't be forked, as this script would be run again in each worker
+	if processes < 2:
+		return None
+	if hasattr(multiprocessing, 'get_all_start_methods'):
+		if 'fork' not in multiprocessing.get_all_start_methods():
+			return None
+		return multiprocessing.get_context('fork').Pool(processes)
+	if sys.platform.startswith('win'):
+		return None
+	return multiprocessing.Pool(processes)
+
+def save_binning_checkpoint(position, level_rows, unclustered_rows):
+	# position is (dimension number, taxonomic level number, number of partitions of the level merged), and
+	# level_rows are the rows being binned at that level. Clusters are kept as the merged rounds, from which
+	# cluster_column and global_cluster_info are rebuilt on --resume
+	dbscan_functions.write_checkpoint(binning_checkpoint_path, { 'fingerprint': fingerprint, 'position': position, 'level_rows': level_rows,
+		'unclustered_rows': unclustered_rows, 'round_counter': round_counter, 'merged_rounds': merged_rounds })
+
+def partition_checkpoint_path(dimension_number, level_number, partition_number):
+	return os.path.join(checkpoint_dir, 'partition_{}_{}_{}.pkl'.format(dimension_number, level_number, partition_number))
+
+# Binning is checkpointed as it goes in checkpoint_dir, so that it can be resumed if this script is stopped.
+# A checkpoint is only used if the contigs, coordinates, markers and binning parameters are the same
+binning_dimensions = [2, 3]
+if has_taxonomy_info and data_size > 50:
+	binning_levels = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+	taxonomy_values = [ master_table[taxonomic_level].values for taxonomic_level in binning_levels ]
 else:
-	for dimensions in [2, 3]:
-		while True:
-			if local_current_table.empty:
-				break
-			round_counter += 1
-			logger.info('Running DBSCAN round ' + str(round_counter))
+	# Without taxonomy all the contigs are one partition
+	binning_levels = [None]
+	taxonomy_values = list()
+fingerprint = dbscan_functions.binning_fingerprint([ master_table['contig'].values, contig_points, marker_counts.matrix.data,\
+	marker_counts.matrix.indices, marker_counts.matrix.indptr ] + taxonomy_values,\
+	[ domain, completeness_cutoff, purity_cutoff, dbscan_engine, eps_search, eps_budget, min_cluster_size, binning_levels ])
+binning_checkpoint_path = os.path.join(checkpoint_dir, 'binning.pkl')
+
+merged_rounds = list() # (round number, cluster information, clustered rows, cluster labels) of each round so far
+resume_position = (0, 0, 0)
+saved_binning = dbscan_functions.read_checkpoint(binning_checkpoint_path) if resume else None
+stale_checkpoints = not resume
+if resume and saved_binning is None:
+	# A partition of the first level may still have been checkpointed
+	logger.info('No binning checkpoint found in ' + checkpoint_dir + ', binning from the start of the first level')
+elif saved_binning is not None and saved_binning['fingerprint'] != fingerprint:
+	logger.info('The checkpoint in ' + checkpoint_dir + ' is for different contigs or parameters, binning from the start')
+	saved_binning = None
+	stale_checkpoints = True
+
+if saved_binning is not None:
+	resume_position = saved_binning['position']
+	round_counter = saved_binning['round_counter']
+	for round_number, cluster_information, clustered_rows, clustered_labels in saved_binning['merged_rounds']:
+		assign_clusters(round_number, cluster_information, clustered_rows, clustered_labels)
+		merged_rounds.append((round_number, cluster_information, clustered_rows, clustered_labels))
+	logger.info('Resuming binning after round ' + str(round_counter) + ' from ' + binning_checkpoint_path)
+
+# Checkpoints left by an earlier run are cleared unless they are being resumed, so that none of them can be picked up by mistake
+if stale_checkpoints and os.path.isdir(checkpoint_dir):
+	shutil.rmtree(checkpoint_dir)
+if not os.path.isdir(checkpoint_dir):
+	os.makedirs(checkpoint_dir)
+
+binning_start_time = time.time()
+# The classifications at each taxonomic level are binned independently, so they run in a pool of processes
+partition_pool = make_partition_pool(processors) if binning_levels != [None] else None
+for dimension_number, dimensions in enumerate(binning_dimensions):
+	if binning_levels != [None]:
+		logger.info('Further splitting according to taxonomic classifications')
+	for level_number, taxonomic_level in enumerate(binning_levels):
+		if (dimension_number, level_number) < resume_position[:2]:
+			continue
+		unclustered_rows = list()
+		first_partition = 0
+		if saved_binning is not None and (dimension_number, level_number) == resume_position[:2]:
+			local_current_rows = saved_binning['level_rows']
+			unclustered_rows = saved_binning['unclustered_rows']
+			first_partition = resume_position[2]
+
+		if taxonomic_level is None:
+			level_values = None
+			classifications = [None]
+		else:
+			logger.info('Taxonomic level: ' + taxonomic_level)
+			# Classifications at the current level, in order of first appearance
+			level_values = master_table[taxonomic_level].values[local_current_rows]
+			classifications = pd.unique(level_values)
 
-			#db_tables = runDBSCANs(local_current_table, dimensions)
-			cluster_information, contig_cluster_dictionary, unclustered_table = runDBSCANs(local_current_table, dimensions, contig_markers, domain, completeness_cutoff, purity_cutoff)
+		# Skip iteration if the current taxonomic level is empty
+		if not len(classifications):
+			continue
 
-			if not cluster_information:
-				break
+		tasks = list()
+		for partition_number, classification in enumerate(classifications):
+			if partition_number < first_partition:
+				continue
+			# Get subset rows
+			if taxonomic_level is None:
+				subset_rows = local_current_rows
+				description = 'all contigs in ' + str(dimensions) + ' dimensions'
+			else:
+				subset_rows = local_current_rows[level_values == classification]
+				description = taxonomic_level + ' ' + str(classification)
+			tasks.append((partition_number, subset_rows, dimensions, description, partition_checkpoint_path(dimension_number, level_number, partition_number)))
+
+		# The largest partitions are started first, so that they don't hold up the end of the level
+		partition_results = dict()
+		if partition_pool is not None and len(tasks) > 1:
+			tasks.sort(key=lambda task: len(task[1]), reverse=True)
+			for partition_number, result in partition_pool.imap_unordered(bin_partition_task, tasks):
+				partition_results[partition_number] = result
+		else:
+			for task in tasks:
+				logger.info('Examining ' + task[3])
+				partition_number, result = bin_partition_task(task)
+				partition_results[partition_number] = result
+
+		# Results are merged in order of classification, so cluster names don't depend on which partition finished first
+		for partition_number in range(first_partition, len(classifications)):
+			found_rounds, rounds_run, subset_rows = partition_results[partition_number]
+			round_counter = merge_partition(round_counter, found_rounds, rounds_run)
+
+			# Add the rows left unclustered to the combined unclustered rows
+			unclustered_rows.append(subset_rows)
+
+			if found_rounds:
+				save_binning_checkpoint((dimension_number, level_number, partition_number + 1), local_current_rows, unclustered_rows)
+			checkpoint_path = partition_checkpoint_path(dimension_number, level_number, partition_number)
+			if os.path.isfile(checkpoint_path):
+				os.remove(checkpoint_path)
+
+		local_current_rows = np.concatenate(unclustered_rows)
+		if level_number + 1 < len(binning_levels):
+			save_binning_checkpoint((dimension_number, level_number + 1, 0), local_current_rows, list())
+		else:
+			save_binning_checkpoint((dimension_number + 1, 0, 0), local_current_rows, list())
 
-			# Populate the global data structures
-			for	cluster in cluster_information:
-				new_cluster_name = 'DBSCAN' + '_round' + str(round_counter) + '_' + str(cluster)
-				global_cluster_info[new_cluster_name] = cluster_information[cluster]
+if partition_pool is not None:
+	partition_pool.close()
+	partition_pool.join()
 
-			for contig in contig_cluster_dictionary:
-				new_cluster_name = 'DBSCAN' + '_round' + str(round_counter) + '_' + str(contig_cluster_dictionary[contig])
-				table_indices = master_table[master_table['contig'] == contig].index.tolist()
-				master_table.at[table_indices[0], 'cluster'] = new_cluster_name
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# ru_maxrss is in kilobytes on Linux but in bytes on macOS
+if platform.system() != 'Darwin':
+	peak_rss *= 1024
+logger.info('Recursive DBSCAN of {} contigs: {} rounds in {:.1f} s, peak RSS {:.0f} MB'.format(data_size, round_counter, time.time() - binning_start_time, peak_rss / 1048576.0))
 
-			local_current_table = unclustered_table
+master_table['cluster'] = cluster_column
 
 # Output table
 master_table.to_csv(path_or_buf=output_table_path, sep='\t', index=False, quoting=csv.QUOTE_NONE)
+
+# Binning is finished, so the checkpoints are no longer needed
+shutil.rmtree(checkpoint_dir)
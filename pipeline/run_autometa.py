@@ -23,6 +23,7 @@ import time
 import logging
 import os
 import platform
+import resource
 import shutil
 
 from multiprocessing import cpu_count
@@ -68,15 +69,69 @@ def init_logger(autom_path, db_path, out_path):
 		logger.info('DB (fname, size): {} {}'.format(fpath, os.stat(db_path+'/'+fpath).st_size))
 	return logger
 
+def wait_for_command(process, command_string):
+	# Waits for a command started with subprocess.Popen and returns its exit code. The resource usage
+	# from wait4 gives the peak RSS of the command (the largest of the shell and its children, which
+	# can't be less than the RSS of run_autometa.py when it forked)
+	_, status, resources = os.wait4(process.pid, 0)
+	if memory_report:
+		peak_rss = resources.ru_maxrss
+		# ru_maxrss is in kilobytes on Linux but in bytes on macOS
+		if platform.system() != 'Darwin':
+			peak_rss *= 1024
+		stage = os.path.basename(command_string.split()[0])
+		stage_peak_rss.append((stage, peak_rss))
+		# Only the stages that hold the main k-mer arrays get an estimate (see report_kmer_memory)
+		if stage in stage_estimates:
+			estimate = 'estimated {}'.format(format_bytes(stage_estimates.pop(stage)))
+		else:
+			estimate = 'no estimate'
+		logger.info('Memory report: {} peak RSS {} ({})'.format(stage, format_bytes(peak_rss), estimate))
+	if os.WIFSIGNALED(status):
+		return -os.WTERMSIG(status)
+	return os.WEXITSTATUS(status)
+
+def format_bytes(num_bytes):
+	return '{:.1f} MB'.format(num_bytes / 1048576.0)
+
+def estimate_kmer_memory(lengths):
+	# Returns the estimated bytes of the k-mer counts, the normalized matrix and the PCA output for contigs of the given lengths
+	# Note - this doesn't import kmer_functions, so that run_autometa.py (whose RSS every forked stage starts from) stays small
+	num_contigs = len(lengths)
+	num_columns = (4**k_mer_size + (4**(k_mer_size // 2) if k_mer_size % 2 == 0 else 0)) // 2 # Canonical k-mers
+	if k_mer_size >= 6:
+		# Sparse counts (see kmer_functions.SPARSE_K_MER_SIZE). A contig can't have more distinct k-mers than it has
+		# k-mers, and each count is held as uint32 plus an int32 column index
+		nonzero = sum(min(max(length - k_mer_size, 0), num_columns) for length in lengths)
+		counts = nonzero * 8 + (num_contigs + 1) * 4
+		normalized = counts + num_contigs * 8
+	else:
+		counts = num_contigs * num_columns * 4
+		normalized = num_contigs * num_columns * 4
+	return { 'counts': counts, 'normalized': normalized, 'pca': num_contigs * 50 * 4 }
+
+def report_kmer_memory(stage, table_path):
+	# Logs the estimated size of the main k-mer arrays of a stage, from the lengths of the contigs in its input table
+	# The estimate is logged again next to the peak RSS of the stage, other stages are logged with 'no estimate'
+	if not memory_report:
+		return
+	with open(table_path) as table:
+		length_column = table.readline().rstrip('\n').split('\t').index('length')
+		lengths = [ int(line.split('\t')[length_column]) for line in table ]
+	estimates = estimate_kmer_memory(lengths)
+	stage_estimates[stage] = sum(estimates.values())
+	logger.info('Memory report: {} estimated {} for {} contigs (k-mer counts {}, normalized {}, PCA {})'.format(stage,\
+		format_bytes(sum(estimates.values())), len(lengths), format_bytes(estimates['counts']), format_bytes(estimates['normalized']), format_bytes(estimates['pca'])))
+
 def run_command(command_string, stdout_path = None):
 	# Function that checks if a command ran properly. If it didn't, then print an error message then quit
 	logger.info('run_autometa.py, run_command: ' + command_string)
 	if stdout_path:
 		f = open(stdout_path, 'w')
-		exit_code = subprocess.call(command_string, stdout=f, shell=True)
+		exit_code = wait_for_command(subprocess.Popen(command_string, stdout=f, shell=True), command_string)
 		f.close()
 	else:
-		exit_code = subprocess.call(command_string, shell=True)
+		exit_code = wait_for_command(subprocess.Popen(command_string, shell=True), command_string)
 
 	if exit_code != 0:
 		print('run_autometa.py: Error, the command:')
@@ -85,7 +140,7 @@ def run_command(command_string, stdout_path = None):
 		exit(1)
 
 def run_command_quiet(command_string):
-	exit_code = subprocess.call(command_string, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+	exit_code = wait_for_command(subprocess.Popen(command_string, shell=True, stdout=FNULL, stderr=subprocess.STDOUT), command_string)
 
 	if exit_code !=0:
 		print('run_autometa.py: Error, the command:')
@@ -118,7 +173,7 @@ def lca_compilation_check():
 
 def run_make_taxonomy_tab(fasta, length_cutoff):
 	"""Runs make_taxonomy_table.py and directs output to taxonomy.tab for run_autometa.py"""
-	# Note we don't have to supply the cov_table here because earlier in this script we already run make_contig_table.py
+	# Note we don't have to supply the cov_table here because earlier in this script we already run make_contig_features.py
 	output_path = output_dir + '/taxonomy.tab'
 	if cov_table:
 		run_command("{}/make_taxonomy_table.py -a {} -db {} -p {} -l {} -o {} -v {}".\
@@ -128,24 +183,19 @@ def run_make_taxonomy_tab(fasta, length_cutoff):
 			format(pipeline_path, fasta, db_dir_path, processors, length_cutoff, output_dir))
 	return output_path
 
-def length_trim(fasta,length_cutoff):
-	#will need to update path of this perl script
-	outfile_name, ext = os.path.splitext(os.path.basename(fasta))
-	outfile_name += ".filtered" + ext
-	output_path = output_dir + '/' + outfile_name
-	run_command("{}/fasta_length_trim.pl {} {} {}".format(pipeline_path, fasta, length_cutoff,output_path))
-	return output_path
-
-def make_contig_table(fasta, coverage_table=None):
-	# Fasta is an absolute path
-	output_filename, _ = os.path.splitext(os.path.basename(fasta))
-	output_filename += '.tab'
-	output_path = output_dir + '/' + output_filename
+def make_contig_features(fasta, length_cutoff, coverage_table=None):
+	# Reads the assembly once to make the length filtered assembly, the contig table and the k-mer counts
+	# (added to the k-mer cache used later by recursive_dbscan.py)
+	filtered_name, ext = os.path.splitext(os.path.basename(fasta))
+	filtered_name += ".filtered"
+	filtered_path = output_dir + '/' + filtered_name + ext
+	table_path = output_dir + '/' + filtered_name + '.tab'
+	k_mer_cache_dir = output_dir + '/k-mer_cache'
+	command = "{}/make_contig_features.py -a {} -l {} -f {} -o {} --k_mer_cache {} --k_mer_size {} -p {}".format(pipeline_path, fasta, length_cutoff, filtered_path, table_path, k_mer_cache_dir, k_mer_size, processors)
 	if coverage_table:
-		run_command("{}/make_contig_table.py -a {} -c {} -o {}".format(pipeline_path,fasta,coverage_table,output_path))
-	else:
-		run_command("{}/make_contig_table.py -a {} -o {}".format(pipeline_path,fasta,output_path))
-	return output_path
+		command += " -c {}".format(coverage_table)
+	run_command(command)
+	return filtered_path, table_path
 
 def make_marker_table(fasta):
 	if kingdom == 'bacteria':
@@ -176,7 +226,8 @@ def make_marker_table(fasta):
 def recursive_dbscan(input_table, filtered_assembly, domain):
 	recursive_dbscan_output_path = output_dir + '/recursive_dbscan_output.tab'
 	k_mer_file = output_dir + '/k-mer_matrix'
-	run_command("{}/recursive_dbscan.py -t {} -a {} -d {} -k {}".format(pipeline_path, input_table, filtered_assembly, output_dir, domain))
+	report_kmer_memory('recursive_dbscan.py', input_table)
+	run_command("{}/recursive_dbscan.py -t {} -a {} -d {} -k {} -p {} --k_mer_size {} --embedding {}".format(pipeline_path, input_table, filtered_assembly, output_dir, domain, processors, k_mer_size, embedding))
 
 	return recursive_dbscan_output_path, k_mer_file
 
@@ -216,6 +267,7 @@ def combine_tables(table1_path, table2_path):
 
 def ML_recruitment(input_table, matrix):
 	ML_recruitment_output_path = output_dir + '/ML_recruitment_output.tab'
+	report_kmer_memory('ML_recruitment.py', input_table)
 	run_command("{}/ML_recruitment.py -t {} -p {} -r -m {} -o {}".format(pipeline_path, input_table, processors, matrix, ML_recruitment_output_path))
 
 	return ML_recruitment_output_path
@@ -239,6 +291,9 @@ parser.add_argument('-r', '--ML_recruitment', help='Use ML to further recruit un
 parser.add_argument('-m', '--maketaxtable', action='store_true',\
 help='runs make_taxonomy_table.py before performing autometa binning. Must specify databases directory (-db)')
 parser.add_argument('-db', '--db_dir', metavar='<dir>', help="Path to directory with taxdump files. If this doesn't exist, the files will be automatically downloaded", required=False, default=autometa_path + '/databases')
+parser.add_argument('--k_mer_size', metavar='<int>', help='Length of k-mers to use for binning (3-8)', type=int, choices=range(3, 9), default=5)
+parser.add_argument('--embedding', metavar='<bhsne|fftsne|umap>', help='Method used to embed k-mer features in 2D (fftsne needs openTSNE, umap needs umap-learn)', choices=['bhsne', 'fftsne', 'umap'], default='bhsne')
+parser.add_argument('--memory_report', help='Log the estimated memory and the peak RSS of each stage', action='store_true')
 parser.add_argument('-v', '--cov_table', metavar='<coverage.tab>', help="Path to coverage table made by calculate_read_coverage.py. If this is not specified then coverage information will be extracted from contig names (SPAdes format)", required=False)
 
 args = vars(parser.parse_args())
@@ -254,6 +309,11 @@ do_ML_recruitment = args['ML_recruitment']
 make_tax_table = args['maketaxtable']
 db_dir_path = os.path.abspath(args['db_dir'])
 cov_table = args['cov_table']
+k_mer_size = args['k_mer_size']
+embedding = args['embedding']
+memory_report = args['memory_report']
+stage_peak_rss = list() # (stage, peak RSS in bytes) for each command run, if memory_report
+stage_estimates = dict() # Estimated bytes, keyed by stage, for the next run of that stage
 
 # Make output directory if it doesn't exist
 if not os.path.isdir(output_dir):
@@ -282,12 +342,8 @@ logger.info('Input command: ' + ' '.join(sys.argv))
 start_time = time.time()
 FNULL = open(os.devnull, 'w')
 
-#run length trim and store output name
-filtered_assembly = length_trim(fasta_assembly, length_cutoff)
-if cov_table:
-	contig_table = make_contig_table(filtered_assembly, cov_table)
-else:
-	contig_table = make_contig_table(filtered_assembly)
+#run length trim, make the contig table and count k-mers, and store output names
+filtered_assembly, contig_table = make_contig_features(fasta_assembly, length_cutoff, cov_table)
 marker_tab_path = make_marker_table(filtered_assembly)
 
 # Ensure lca functions are compiled and up-to-date
@@ -336,6 +392,13 @@ if do_ML_recruitment:
 
 elapsed_time = time.strftime('%H:%M:%S', time.gmtime(round((time.time() - start_time),2)))
 
+if memory_report and stage_peak_rss:
+	largest_stage, largest_peak_rss = max(stage_peak_rss, key=lambda stage_rss: stage_rss[1])
+	own_peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if platform.system() != 'Darwin':
+		own_peak_rss *= 1024
+	logger.info('Memory report: largest peak RSS was {} ({}), run_autometa.py itself used {}'.format(format_bytes(largest_peak_rss), largest_stage, format_bytes(own_peak_rss)))
+
 print "Done!"
 print "Elapsed time is {} (HH:MM:SS)".format(elapsed_time)
 logger.info('Done!')